@@ -1,38 +1,71 @@
 #! /bin/python
 
+from __future__ import annotations
+
+import argparse
+import codecs
+import contextvars
+import ctypes
 import os
-import ftplib
+import fcntl
+import hashlib
+import html
+import http.client
+import importlib.util
+import json
+import mmap
 import re
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import signal
+import time
+from contextlib import contextmanager, redirect_stdout
 from functools import partial
+from html.parser import HTMLParser
 from os.path import exists
-from threading import Event
-from urllib.request import urlopen
-
-from click import pause
-from simple_term_menu import TerminalMenu
-import requests
-from bs4 import BeautifulSoup
-
-from rich.console import Console
-from rich.progress import (
-    BarColumn,
-    DownloadColumn,
-    Progress,
-    TaskID,
-    TextColumn,
-    TimeRemainingColumn,
-    TransferSpeedColumn,
-)
+from queue import PriorityQueue
+from threading import BoundedSemaphore, Event, Lock, Thread
+from typing import TYPE_CHECKING, NamedTuple, Optional
+from urllib.parse import quote, unquote, urlsplit
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+# requests, asyncio, aiohttp, ftplib, http.server, rich and simple_term_menu are imported
+# where they are needed so the menu comes up without paying for the network stack
+if TYPE_CHECKING:
+    from rich.progress import TaskID
 
 # const vars
 MODULE_PATH = "./Modules/"
 SETTINGS_FILE = "./ISO-Manager.conf"
+HTTP_CATEGORIES = ["garuda", "kali", "mint", "manjaro"]
+# mirrors are reached over these, benchmark.py points them at local stand-ins
+HTTP_SCHEME = "https"
+FTP_PORT = 21
+RESOLVE_WORKERS = 16
+FTP_TIMEOUT = 30
+HTTP_TIMEOUT = 30
+STATE_DIR = ".iso-manager"
+PART_SUFFIX = ".part"
+STORE_DIR = ".store"
+FICLONE = 0x40049409
+FALLOC_FL_KEEP_SIZE = 0x01
+HASH_CHUNK = 1024 * 1024
+LISTING_CHUNK = 16 * 1024
+MIRROR_PROBE_TIMEOUT = 10
+VERIFY_CHUNK = 16 * 1024 * 1024
+# read sizes and progress refresh of the asyncio download engine
+ASYNC_READ_MIN = 64 * 1024
+ASYNC_READ_MAX = 4 * 1024 * 1024
+PROGRESS_REFRESH = 0.25
+# published checksum list per category, other categories ship a <iso>.sha256 next to the image
+CHECKSUM_FILES = {"ubuntu": "SHA256SUMS", "arch": "sha256sums.txt", "kali": "SHA256SUMS", "mint": "sha256sum.txt"}
 
 #run vars
 downloaded_distros = []
+refresh_listings = False
 
 #test vars
 BLOCK_DOWNLOAD = False
@@ -41,20 +74,129 @@ TEST_FTP_CONNECTION = False
 # settings
 download_path = ""
 max_simultaneous_downloads = 0
+max_connections_per_server = 4
+listing_cache_ttl = 3600
+segments_per_download = 1
+segment_retries = 3
+verify_checksums = 1
+checksum_refetch = 1
+mirror_ranking_ttl = 86400
+mirror_sample_bytes = 262144
+download_order = "largest"
+max_bandwidth = 0
+bandwidth_schedule = []
+delta_updates = 1
+content_store = 1
+store_link_mode = "hardlink"
+retention_keep = 2
+retention_max_age_days = 0
+retention_max_old_size = 0
+retention_auto = 1
+download_engine = "threads"
+chunk_size = 1024 * 1024
+metrics = 1
+metrics_textfile = ""
+lan_cache = ""
+serve_address = "0.0.0.0"
+serve_port = 8080
+sync_interval = 3600
 
 def clear():
     os.system('clear')
 
 
+def parse_conf(lines):
+    conf = {}
+    for line in lines:
+        if '= ' in line:
+            key, value = line.split('= ', 1)
+            conf[key.strip()] = value.strip()
+
+    return conf
+
+
+def parse_size(value):
+    """Turn a size like 512K, 20M or 1G into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value or 0)
+
+
+def parse_schedule(value):
+    """Parse 'HH:MM-HH:MM=rate, ...' into (start minute, end minute, bytes per second) windows."""
+    windows = []
+    for window in value.split(","):
+        if "=" not in window:
+            continue
+        hours, rate = window.split("=")
+        start, end = [int(part.split(":")[0]) * 60 + int(part.split(":")[1]) for part in hours.strip().split("-")]
+        windows.append((start, end, parse_size(rate)))
+    return windows
+
+
 def read_settings(settings_file):
     global download_path
     global max_simultaneous_downloads
-
-    with open(f'{SETTINGS_FILE}', 'r') as file:
-        conf_data = file.readlines()
-
-    download_path = conf_data[0].split('= ')[1].strip()
-    max_simultaneous_downloads = int(conf_data[1].split('= ')[1].strip())
+    global max_connections_per_server
+    global listing_cache_ttl
+    global segments_per_download
+    global segment_retries
+    global verify_checksums
+    global checksum_refetch
+    global mirror_ranking_ttl
+    global mirror_sample_bytes
+    global download_order
+    global max_bandwidth
+    global bandwidth_schedule
+    global delta_updates
+    global content_store
+    global store_link_mode
+    global retention_keep
+    global retention_max_age_days
+    global retention_max_old_size
+    global retention_auto
+    global download_engine
+    global chunk_size
+    global metrics
+    global metrics_textfile
+    global lan_cache
+    global serve_address
+    global serve_port
+    global sync_interval
+
+    with open(settings_file, 'r') as file:
+        conf_data = parse_conf(file.readlines())
+
+    download_path = conf_data["dest_dir"]
+    max_simultaneous_downloads = int(conf_data["max_simultaneous_downloads"])
+    max_connections_per_server = int(conf_data.get("max_connections_per_server", max_connections_per_server))
+    listing_cache_ttl = int(conf_data.get("listing_cache_ttl", listing_cache_ttl))
+    segments_per_download = int(conf_data.get("segments_per_download", segments_per_download))
+    segment_retries = int(conf_data.get("segment_retries", segment_retries))
+    verify_checksums = int(conf_data.get("verify_checksums", verify_checksums))
+    checksum_refetch = int(conf_data.get("checksum_refetch", checksum_refetch))
+    mirror_ranking_ttl = int(conf_data.get("mirror_ranking_ttl", mirror_ranking_ttl))
+    mirror_sample_bytes = int(conf_data.get("mirror_sample_bytes", mirror_sample_bytes))
+    download_order = conf_data.get("download_order", download_order)
+    max_bandwidth = parse_size(conf_data.get("max_bandwidth", "0"))
+    bandwidth_schedule = parse_schedule(conf_data.get("bandwidth_schedule", ""))
+    delta_updates = int(conf_data.get("delta_updates", delta_updates))
+    content_store = int(conf_data.get("content_store", content_store))
+    store_link_mode = conf_data.get("store_link_mode", store_link_mode)
+    retention_keep = int(conf_data.get("retention_keep", retention_keep))
+    retention_max_age_days = int(conf_data.get("retention_max_age_days", retention_max_age_days))
+    retention_max_old_size = parse_size(conf_data.get("retention_max_old_size", "0"))
+    retention_auto = int(conf_data.get("retention_auto", retention_auto))
+    download_engine = conf_data.get("download_engine", download_engine)
+    chunk_size = parse_size(conf_data.get("chunk_size", str(chunk_size)))
+    metrics = int(conf_data.get("metrics", metrics))
+    metrics_textfile = conf_data.get("metrics_textfile", metrics_textfile)
+    lan_cache = conf_data.get("lan_cache", lan_cache).rstrip("/")
+    serve_address = conf_data.get("serve_address", serve_address)
+    serve_port = int(conf_data.get("serve_port", serve_port))
+    sync_interval = int(conf_data.get("sync_interval", sync_interval))
 
 
 def setup():
@@ -63,17 +205,145 @@ def setup():
         os.makedirs(download_path)
 
 
-progress = Progress(
-    TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
-    BarColumn(bar_width=None),
-    "[progress.percentage]{task.percentage:>3.1f}%",
-    "•",
-    DownloadColumn(),
-    "•",
-    TransferSpeedColumn(),
-    "•",
-    TimeRemainingColumn(),
-)
+def state_file(name):
+    return os.path.join(download_path, STATE_DIR, name)
+
+
+def load_state(name):
+    try:
+        with open(state_file(name), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(name, data):
+    path = state_file(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w') as file:
+        json.dump(data, file, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+# the module a resolver or download is working on, for the metrics it records
+current_module = contextvars.ContextVar("current_module", default=None)
+metric_events = []
+metrics_lock = Lock()
+metrics_run = 0.0
+
+
+def url_host(url):
+    return urlsplit(url).netloc
+
+
+def record_metric(phase, seconds, **fields):
+    """Remember one timed phase of the current module for the metrics of this run."""
+    event = {"time": time.time(), "module": current_module.get(), "phase": phase, "seconds": round(seconds, 6)}
+    event.update(fields)
+    with metrics_lock:
+        metric_events.append(event)
+
+
+@contextmanager
+def timed(phase, **fields):
+    """Record how long the block takes as phase, the block may add fields like bytes."""
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as error:
+        fields["error"] = type(error).__name__
+        raise
+    finally:
+        record_metric(phase, time.perf_counter() - start, **fields)
+
+
+def start_metrics():
+    global metrics_run
+
+    with metrics_lock:
+        metric_events.clear()
+    metrics_run = time.time()
+
+
+def prometheus_labels(labels):
+    escaped = {key: str(value or "").replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for key, value in labels.items()}
+    return ",".join(f'{key}="{value}"' for key, value in escaped.items())
+
+
+def write_metrics():
+    """Append the events of this run to metrics.jsonl and export them for the Prometheus textfile collector.
+
+    The textfile holds the totals of the last run per phase, module and
+    server, so transfer throughput is bytes / seconds of the transfer phase.
+    """
+    if not metrics:
+        return
+
+    with metrics_lock:
+        events = list(metric_events)
+
+    path = state_file("metrics.jsonl")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as file:
+        for event in events:
+            file.write(json.dumps({"run": metrics_run, **event}) + "\n")
+
+    totals = {}
+    for event in events:
+        key = (event["phase"], event["module"], event.get("server"))
+        total = totals.setdefault(key, {"seconds": 0.0, "count": 0, "bytes": 0, "errors": 0})
+        total["seconds"] += event["seconds"]
+        total["count"] += 1
+        total["bytes"] += event.get("bytes", 0)
+        total["errors"] += "error" in event
+
+    lines = []
+    for name, field, description in (
+            ("iso_manager_phase_seconds", "seconds", "Seconds spent in a phase during the last run."),
+            ("iso_manager_phase_count", "count", "How often a phase ran during the last run, retries included."),
+            ("iso_manager_phase_bytes", "bytes", "Bytes moved by a phase during the last run."),
+            ("iso_manager_phase_errors", "errors", "Phases that ended with an error during the last run.")):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for (phase, module, server), total in sorted(totals.items(), key=lambda item: [str(part) for part in item[0]]):
+            labels = prometheus_labels({"phase": phase, "module": module, "server": server})
+            lines.append(f"{name}{{{labels}}} {total[field]}")
+    lines.append("# HELP iso_manager_last_run_timestamp_seconds Start of the last run.")
+    lines.append("# TYPE iso_manager_last_run_timestamp_seconds gauge")
+    lines.append(f"iso_manager_last_run_timestamp_seconds {metrics_run}")
+    lines.append("# HELP iso_manager_last_run_duration_seconds Wall time of the last run.")
+    lines.append("# TYPE iso_manager_last_run_duration_seconds gauge")
+    lines.append(f"iso_manager_last_run_duration_seconds {time.time() - metrics_run:.3f}")
+
+    # the collector may read at any moment, so the file is replaced in one step
+    textfile = metrics_textfile or state_file("iso-manager.prom")
+    with open(f"{textfile}.tmp", "w") as file:
+        file.write("\n".join(lines) + "\n")
+    os.replace(f"{textfile}.tmp", textfile)
+
+
+progress = None
+
+
+def download_progress():
+    """Create the progress display shared by all downloads on first use."""
+    global progress
+    from rich.progress import BarColumn, DownloadColumn, Progress, TextColumn, TimeRemainingColumn, TransferSpeedColumn
+
+    if progress is None:
+        progress = Progress(
+            TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
+            BarColumn(bar_width=None),
+            "[progress.percentage]{task.percentage:>3.1f}%",
+            "•",
+            DownloadColumn(),
+            "•",
+            TransferSpeedColumn(),
+            "•",
+            TimeRemainingColumn(),
+        )
+    return progress
 
 
 done_event = Event()
@@ -86,44 +356,883 @@ def handle_sigint(signum, frame):
 signal.signal(signal.SIGINT, handle_sigint)
 
 
-def copy_url(task_id: TaskID, url: str, path: str) -> None:
-    """Copy data from a url to a local file."""
-    # progress.console.log(f"Requesting {url}")
-    response = urlopen(url)
-    # This will break if the response doesn't contain content length
-    progress.update(task_id, total=int(response.info()["Content-length"]))
-    with open(path, "wb") as dest_file:
+def read_part_meta(part_path):
+    try:
+        with open(f"{part_path}.json", 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_part_meta(part_path, meta):
+    with open(f"{part_path}.json", 'w') as file:
+        json.dump(meta, file)
+
+
+def content_range_total(response):
+    """Return the full size announced in a Content-Range header, if any."""
+    content_range = response.headers.get("Content-Range", "")
+    total = content_range.split("/")[-1]
+    return int(total) if total.isdigit() else None
+
+
+def resume_headers(url, part_path):
+    """Return the offset, metadata and request headers to continue a .part file from."""
+    meta = read_part_meta(part_path)
+    offset = os.path.getsize(part_path) if meta and exists(part_path) else 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        # If-Range makes the server send the whole file when it changed in between,
+        # validators of another mirror mean nothing here so those resume by size alone
+        etag = meta.get("etag")
+        validator = etag if etag and not etag.startswith("W/") else meta.get("last_modified")
+        if validator and meta.get("url") == url:
+            headers["If-Range"] = validator
+    return offset, meta, headers
+
+
+def resumed(response, offset, meta):
+    """Tell whether a response continues the .part file at offset."""
+    return bool(offset and response.status == 206 and content_range_total(response) == meta.get("size"))
+
+
+def part_meta(url, response):
+    """Describe the remote file of a full response for the .part.json sidecar."""
+    length = response.headers.get("Content-Length")
+    return {
+        "url": url,
+        "size": int(length) if length else None,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def part_complete(part_path):
+    """Tell whether a single stream .part already holds the whole file.
+
+    That happens when a download stops between its last write and the rename,
+    asking the server for the rest would only get a 416.
+    """
+    meta = read_part_meta(part_path)
+    return ("segments" not in meta and meta.get("size") is not None and exists(part_path)
+            and os.path.getsize(part_path) == meta["size"])
+
+
+def check_received(received, meta):
+    """Raise when a response ended before the size it announced.
+
+    Mirrors that drop the connection make the read return nothing instead of
+    failing, the exception lets the caller continue the .part on the next mirror.
+    """
+    if meta["size"] is not None and received != meta["size"]:
+        raise http.client.HTTPException(f"connection closed after {received} of {meta['size']} bytes")
+
+
+def resume_requests(url, part_path):
+    """Decide the requests that open url, continuing an earlier partial download if possible.
+
+    Both download engines drive this generator: it yields the headers of the
+    next request and is sent the response, or thrown the HTTP error the server
+    answered with. Every response but the last is closed by the caller. Returns
+    the response, the offset it starts at and the metadata describing the remote file.
+    """
+    offset, meta, headers = resume_headers(url, part_path)
+    try:
+        response = yield headers
+    except Exception as error:
+        if getattr(error, "status", None) != 416 or not offset:
+            raise
+        # the .part is longer than the file the server has now, start over
+        response = yield {}
+    if not resumed(response, offset, meta):
+        if response.status == 206:
+            response = yield {}
+        offset = 0
+        meta = part_meta(url, response)
+        write_part_meta(part_path, meta)
+
+    return response, offset, meta
+
+
+def open_resumable(url, part_path):
+    """Open url with urllib as resume_requests decides, returns like it."""
+    steps = resume_requests(url, part_path)
+    headers = next(steps)
+    while True:
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=HTTP_TIMEOUT)
+        except HTTPError as error:
+            headers = steps.throw(error)
+            continue
+        try:
+            headers = steps.send(response)
+        except StopIteration as done:
+            return done.value
+        response.close()
+
+
+@contextmanager
+def part_writer(task_id, url, part_path, offset, meta):
+    """Open a .part file to continue at offset, yielding it and the fields of its transfer metric."""
+    progress.update(task_id, total=meta["size"], completed=offset)
+    with open(part_path, "ab" if offset else "wb") as dest_file, \
+            timed("transfer", server=url_host(url), bytes=0, offset=offset) as transfer:
+        if meta["size"]:
+            preallocate(dest_file.fileno(), offset, meta["size"] - offset)
         progress.start_task(task_id)
-        for data in iter(partial(response.read, 32768), b""):
-            dest_file.write(data)
-            progress.update(task_id, advance=len(data))
+        yield dest_file, transfer
+
+
+def write_chunk(dest_file, digest, transfer, data):
+    dest_file.write(data)
+    digest.update(data)
+    transfer["bytes"] += len(data)
+
+
+def hash_file(path, digest=None):
+    """Feed the content of a file into a sha256 digest."""
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as file:
+        for data in iter(partial(file.read, HASH_CHUNK), b""):
+            digest.update(data)
+    return digest
+
+
+def preallocate(fd, offset, length):
+    """Reserve the disk blocks of offset..offset + length without changing the file size.
+
+    The size of a .part file is what a single stream download resumes from, so
+    it has to keep growing with the data. Filesystems without fallocate are left as they are.
+    """
+    if length <= 0:
+        return
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+checksums_lock = Lock()
+
+
+def record_checksum(filename, sha256):
+    with checksums_lock:
+        known = load_state("checksums.json")
+        known[filename] = sha256
+        save_state("checksums.json", known)
+
+
+def store_object(sha256):
+    return os.path.join(download_path, STORE_DIR, sha256[:2], sha256)
+
+
+def reflink(source, target):
+    """Clone source to target sharing its blocks, only works on CoW filesystems like btrfs or XFS."""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_from_store(sha256, path):
+    """Materialize a store object at path as a reflink or hardlink, copying as a last resort."""
+    source = store_object(sha256)
+    temp_path = f"{path}.link"
+    if exists(temp_path):
+        os.remove(temp_path)
+
+    linked = False
+    if store_link_mode == "reflink":
+        try:
+            reflink(source, temp_path)
+            linked = True
+        except OSError:
+            if exists(temp_path):
+                os.remove(temp_path)
+    if not linked:
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+    os.replace(temp_path, path)
+
+
+def store_file(source, path, sha256):
+    """Move a verified file into the content store and link it to path.
+
+    Content that is already stored is only linked, so identical images of
+    different modules or categories use the disk space once.
+    """
+    target = store_object(sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if exists(target):
+        os.remove(source)
+    else:
+        os.replace(source, target)
+    link_from_store(sha256, path)
+
+
+def referenced_objects():
+    """Return the hashes of all files the manifest still knows on disk."""
+    referenced = set()
+    for entry in load_state("manifest.json").values():
+        for version in [entry] + entry.get("history", []):
+            if version.get("sha256") and exists(os.path.join(download_path, version["path"])):
+                referenced.add(version["sha256"])
+    return referenced
+
+
+def prune_store():
+    """Delete store objects no category folder uses anymore, returns the freed bytes.
+
+    A hardlinked object is unused once it is its own only link. Reflinks don't
+    share the inode, so in that mode the manifest decides what is still in use.
+    """
+    referenced = referenced_objects() if store_link_mode == "reflink" else None
+    freed = 0
+    for root, dirs, files in os.walk(os.path.join(download_path, STORE_DIR)):
+        for file in files:
+            stat = os.stat(os.path.join(root, file))
+            if (stat.st_nlink == 1) if referenced is None else (file not in referenced):
+                os.remove(os.path.join(root, file))
+                freed += stat.st_size
+    return freed
+
+
+manifest_lock = Lock()
+
+
+def file_version(filename):
+    """Guess the release of an image from its name, preferring dotted versions over build dates."""
+    for pattern in (r"\d+(?:\.\d+)+", r"\d{6,}", r"\d+"):
+        match = re.search(pattern, filename)
+        if match:
+            return match.group(0)
+    return None
+
+
+def record_download(module, path, url, sha256):
+    """Store the file a module was downloaded to in the manifest."""
+    with manifest_lock:
+        manifest = load_state("manifest.json")
+        entry = manifest.setdefault(module, {"history": []})
+        entry.update({
+            "path": os.path.relpath(path, download_path),
+            "file": os.path.basename(path),
+            "version": file_version(os.path.basename(path)),
+            "size": os.path.getsize(path),
+            "sha256": sha256,
+            "url": url,
+            "downloaded": time.time(),
+        })
+        save_state("manifest.json", manifest)
+
+
+def adopt_download(module, category, filename):
+    """Record an older image of a module that was downloaded before the manifest existed.
+
+    Files of the category whose names only differ from filename in their
+    version numbers count as earlier releases, the newest one not claimed by
+    another module is recorded. Returns whether one was found.
+    """
+    folder = os.path.join(download_path, category)
+    if not os.path.isdir(folder):
+        return False
+    # re.escape keeps digits as they are and turns the dots between them into \.
+    pattern = re.compile(re.sub(r"\d+(?:\\\.\d+)*", lambda match: r"\d+(?:\.\d+)*", re.escape(filename)))
+    with manifest_lock:
+        claimed = {entry["path"] for entry in load_state("manifest.json").values()}
+    with os.scandir(folder) as entries:
+        candidates = [entry for entry in entries if entry.is_file() and pattern.fullmatch(entry.name)
+                      and os.path.relpath(entry.path, download_path) not in claimed]
+    if not candidates:
+        return False
+    newest = max(candidates, key=lambda entry: entry.stat().st_mtime)
+    record_download(module, newest.path, None, None)
+    return True
+
+
+def retire_download(module):
+    """Move the current file of a module into the old folder of its category."""
+    with manifest_lock:
+        manifest = load_state("manifest.json")
+        entry = manifest[module]
+        source = os.path.join(download_path, entry["path"])
+        old_dir = os.path.join(os.path.dirname(source), "old")
+        os.makedirs(old_dir, exist_ok=True)
+        shutil.move(source, os.path.join(old_dir, entry["file"]))
+
+        retired = {key: entry[key] for key in ("file", "version", "size", "sha256", "url", "downloaded")}
+        retired["path"] = os.path.relpath(os.path.join(old_dir, entry["file"]), download_path)
+        retired["retired"] = time.time()
+        entry["history"].append(retired)
+        save_state("manifest.json", manifest)
+
+
+def finish_part(part_path, path, digest, expected=None, module=None, url=None):
+    """Verify a completed .part file and move it to its final name.
+
+    A file that doesn't match the published checksum is moved to the
+    quarantine folder next to it instead. Accepted files are recorded in the
+    manifest under their module. Returns whether the file was accepted.
+    """
+    if os.path.exists(f"{part_path}.json"):
+        os.remove(f"{part_path}.json")
+
+    filename = os.path.basename(path)
+    if expected and digest != expected:
+        quarantine = os.path.join(os.path.dirname(path), "quarantine")
+        os.makedirs(quarantine, exist_ok=True)
+        os.replace(part_path, os.path.join(quarantine, filename))
+        progress.console.log(f"[bold red]Checksum mismatch, quarantined: {filename}")
+        return False
+
+    if content_store:
+        store_file(part_path, path, digest)
+    else:
+        os.replace(part_path, path)
+    record_checksum(filename, digest)
+    if module:
+        record_download(module, path, url, digest)
+    return True
+
+
+bandwidth_lock = Lock()
+bandwidth_tokens = 0.0
+bandwidth_stamp = 0.0
+
+
+def current_rate_limit():
+    """Return the bandwidth limit for this time of day in bytes per second, 0 for none."""
+    now = time.localtime()
+    minute = now.tm_hour * 60 + now.tm_min
+    for start, end, rate in bandwidth_schedule:
+        if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+            return rate
+    return max_bandwidth
+
+
+def reserve_bandwidth(amount):
+    """Take amount bytes from the token bucket shared by all downloads.
+
+    Returns how many seconds the caller has to wait before sending more.
+    """
+    global bandwidth_tokens
+    global bandwidth_stamp
+
+    rate = current_rate_limit()
+    if not rate:
+        return 0
+
+    with bandwidth_lock:
+        now = time.monotonic()
+        # the bucket holds at most one second worth of tokens
+        bandwidth_tokens = min(rate, bandwidth_tokens + (now - bandwidth_stamp) * rate)
+        bandwidth_stamp = now
+        bandwidth_tokens -= amount
+        return -bandwidth_tokens / rate if bandwidth_tokens < 0 else 0
+
+
+def throttle(amount):
+    """Wait until the token bucket shared by all downloads allows amount more bytes."""
+    wait = reserve_bandwidth(amount)
+    if wait:
+        time.sleep(wait)
+
+
+def copy_url(task_id: TaskID, url: str, path: str, segments: int = 1, sha256: str = None, module: str = None):
+    """Copy data from a url to a local file.
+
+    Data goes to <path>.part and is only renamed to path once complete, so an
+    interrupted download never looks like a finished ISO and is resumed next time.
+    The file is preallocated from Content-Length and read in chunk_size blocks
+    into one reused buffer. The data is hashed while it is written and checked
+    against sha256 if given.
+    Returns True once the file is in place, False on a checksum mismatch and
+    None if the download was interrupted. A connection that closes early raises,
+    so the next mirror can continue the .part.
+    """
+    part_path = f"{path}{PART_SUFFIX}"
+    if segments > 1 or "segments" in read_part_meta(part_path):
+        return copy_url_segmented(task_id, url, path, max(segments, 2), sha256, module)
+    if part_complete(part_path):
+        return finish_complete_part(task_id, part_path, path, sha256, module, url)
+
+    with timed("download_ttfb", server=url_host(url)):
+        response, offset, meta = open_resumable(url, part_path)
+    digest = hash_file(part_path) if offset else hashlib.sha256()
+    buffer = memoryview(bytearray(chunk_size))
+    with response, part_writer(task_id, url, part_path, offset, meta) as (dest_file, transfer):
+        while length := response.readinto(buffer):
+            write_chunk(dest_file, digest, transfer, buffer[:length])
+            progress.update(task_id, advance=length)
+            throttle(length)
             if done_event.is_set():
-                return
-    # progress.console.log(f"Downloaded {path}")
+                return None
+
+        check_received(dest_file.tell(), meta)
+        dest_file.flush()
+        os.fsync(dest_file.fileno())
+    return finish_part(part_path, path, digest.hexdigest(), sha256, module, url)
+
+
+def finish_complete_part(task_id, part_path, path, sha256=None, module=None, url=None):
+    """Verify and move a .part that needs no more data, see part_complete."""
+    size = os.path.getsize(part_path)
+    progress.update(task_id, total=size, completed=size)
+    return finish_part(part_path, path, hash_file(part_path).hexdigest(), sha256, module, url)
+
+
+def split_segments(start, size, count):
+    """Split the byte range start..size into count [first, last, done] segments."""
+    step = max(1, -(-(size - start) // count))
+    return [[first, min(first + step, size) - 1, 0] for first in range(start, size, step)]
+
+
+def segments_missing(segments):
+    return sum(last - first + 1 - done for first, last, done in segments)
+
+
+def fetch_segment(task_id, url, fd, segment, validator):
+    """Fetch one byte range into fd, retrying from where the last attempt stopped."""
+    attempt = 0
+    buffer = memoryview(bytearray(chunk_size))
+    while segment[0] + segment[2] <= segment[1]:
+        request = Request(url)
+        request.add_header("Range", f"bytes={segment[0] + segment[2]}-{segment[1]}")
+        if validator:
+            request.add_header("If-Range", validator)
+        try:
+            response = urlopen(request, timeout=HTTP_TIMEOUT)
+            if response.status != 206:
+                response.close()
+                raise RuntimeError("server sent the whole file, it changed since the download started")
+
+            while length := response.readinto(buffer):
+                os.pwrite(fd, buffer[:length], segment[0] + segment[2])
+                segment[2] += length
+                progress.update(task_id, advance=length)
+                throttle(length)
+                if done_event.is_set():
+                    return
+            if segment[0] + segment[2] <= segment[1]:
+                # a dropped connection ends the read without an error, it still costs an attempt
+                raise http.client.HTTPException(f"connection closed {segment[1] - segment[0] - segment[2] + 1} bytes "
+                                                f"before the end of the range")
+        except (OSError, http.client.HTTPException) as error:
+            attempt += 1
+            if attempt > segment_retries:
+                raise
+            record_metric("segment_retry", 0, server=url_host(url), error=type(error).__name__)
+            time.sleep(attempt)
+
+
+def copy_url_segmented(task_id, url, path, segments, sha256=None, module=None):
+    """Copy a url to a local file over several concurrent Range requests.
+
+    The .part file is allocated up front and every segment writes at its own
+    offset. Finished byte counts are kept in the .part.json sidecar, so an
+    interrupted segmented download resumes each segment where it stopped.
+    Falls back to a single stream when the server can't serve ranges.
+    """
+    part_path = f"{path}{PART_SUFFIX}"
+    head = urlopen(Request(url, method="HEAD"), timeout=HTTP_TIMEOUT)
+    length = head.headers.get("Content-Length")
+    if not length or head.headers.get("Accept-Ranges") != "bytes":
+        if "segments" in read_part_meta(part_path):
+            os.remove(f"{part_path}.json")
+        return copy_url(task_id, url, path, 1, sha256, module)
+
+    size = int(length)
+    etag = head.headers.get("ETag")
+    last_modified = head.headers.get("Last-Modified")
+    meta = read_part_meta(part_path)
+    unchanged = exists(part_path) and meta.get("size") == size and (meta.get("url") != url or (
+        meta.get("etag") == etag and meta.get("last_modified") == last_modified))
+
+    if not (unchanged and "segments" in meta):
+        # a single stream download of the same file leaves a valid prefix to continue from
+        start = os.path.getsize(part_path) if unchanged else 0
+        meta = {"url": url, "size": size, "etag": etag, "last_modified": last_modified,
+                "segments": split_segments(start, size, segments)}
+        with open(part_path, "ab" if start else "wb") as dest_file:
+            dest_file.truncate(size)
+            preallocate(dest_file.fileno(), start, size - start)
+        write_part_meta(part_path, meta)
+
+    validator = etag if etag and not etag.startswith("W/") else last_modified
+    missing = segments_missing(meta["segments"])
+    progress.update(task_id, total=size, completed=size - missing)
+    progress.start_task(task_id)
+
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with timed("transfer", server=url_host(url), segments=len(meta["segments"])) as transfer, \
+                ThreadPoolExecutor(max_workers=len(meta["segments"]) or 1) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, fetch_segment, task_id, url, fd, segment, validator)
+                       for segment in meta["segments"]]
+            errors = [future.exception() for future in futures if future.exception()]
+            transfer["bytes"] = missing - segments_missing(meta["segments"])
+        if not errors and not done_event.is_set():
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+        write_part_meta(part_path, meta)
+
+    if errors:
+        raise errors[0]
+    if done_event.is_set():
+        return None
+    # segments arrive out of order, so this is the one mode that hashes after the fact
+    return finish_part(part_path, path, hash_file(part_path).hexdigest(), sha256, module, url)
+
+
+def is_lan_url(url):
+    return bool(lan_cache) and url.startswith(f"{lan_cache}/")
+
+
+def mirror_failed(url, error):
+    """Log and count a mirror a job moves on from, a LAN cache miss is expected and counted apart."""
+    if is_lan_url(url):
+        record_metric("lan_miss", 0, server=url_host(url), error=type(error).__name__)
+        progress.console.log(f"{url.split('/')[-1]} isn't in the LAN cache, downloading upstream ({error})")
+    else:
+        record_metric("mirror_retry", 0, server=url_host(url), error=type(error).__name__)
+        progress.console.log(f"[bold yellow]Download from {url} failed ({error})")
+
+
+# what a mirror can fail with mid download, the asyncio engine adds the errors of aiohttp
+MIRROR_ERRORS = (OSError, http.client.HTTPException, RuntimeError)
+
 
+def copy_from_mirrors(task_id, job, dest_path):
+    """Download a job from the first mirror that works, continuing the .part file on the next one."""
+    for url in job["urls"]:
+        try:
+            return copy_url(task_id, url, dest_path, job["segments"], job["sha256"], job["module"])
+        except MIRROR_ERRORS as error:
+            if done_event.is_set():
+                return None
+            mirror_failed(url, error)
+
+    progress.console.log(f"[bold red]Incomplete download, will resume next time: {dest_path}")
+    return None
+
+
+def copy_delta(task_id, job, dest_path):
+    """Build the new image from the previous one with zsync, fetching only the changed blocks.
 
-def download(urls, dest_dirs):
-    """Download multiple files to the given directory."""
+    Needs the zsync tool, a .zsync control file next to the image and a published
+    checksum. Returns None when a delta update isn't possible so the caller
+    downloads the whole file.
+    """
+    # the LAN cache serves images only, the control file has to come from a mirror
+    url = next(url for url in job["urls"] if not is_lan_url(url))
+    zsync = shutil.which("zsync")
+    if not zsync or not exists(job["seed"]) or not job["sha256"]:
+        return None
 
+    # zsync 0.6 only speaks plain http, the sha256 check of finish_part vouches for what it builds
+    control_url = f"{urlsplit(url)._replace(scheme='http').geturl()}.zsync"
+    try:
+        with urlopen(Request(control_url, method="HEAD"), timeout=HTTP_TIMEOUT):
+            pass
+    except (OSError, http.client.HTTPException):
+        return None
+
+    part_path = f"{dest_path}{PART_SUFFIX}"
+    size = remote_size(url)
+    progress.update(task_id, total=size)
+    progress.start_task(task_id)
+    progress.console.log(f"Delta update of {os.path.basename(dest_path)} from {os.path.basename(job['seed'])}")
+
+    # zsync resolves the image url relative to the control file and downloads the missing ranges itself,
+    # it runs in the category folder so the paths handed to it must not be relative to ours
+    with timed("delta", server=url_host(url)) as fields:
+        process = subprocess.Popen([zsync, "-q", "-i", os.path.abspath(job["seed"]), "-o", os.path.abspath(part_path),
+                                    control_url],
+                                   cwd=job["dest_dir"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        while process.poll() is None:
+            if done_event.is_set():
+                process.terminate()
+                process.wait()
+                return None
+            time.sleep(0.5)
+        fields["returncode"] = process.returncode
+
+    if process.returncode != 0 or not exists(part_path):
+        progress.console.log(f"[bold yellow]Delta update failed, downloading the whole file "
+                             f"({process.stderr.read().decode(errors='replace').strip()})")
+        if exists(part_path):
+            os.remove(part_path)
+        return None
+
+    progress.update(task_id, completed=os.path.getsize(part_path))
+    return finish_part(part_path, dest_path, hash_file(part_path).hexdigest(), job["sha256"], job["module"], url)
+
+
+def refetch_attempts(task_id):
+    """Yield the attempts at a job, a checksum mismatch earns checksum_refetch more."""
+    for attempt in range(1 + checksum_refetch):
+        if attempt:
+            record_metric("checksum_retry", 0)
+            progress.reset(task_id, start=False)
+        yield attempt
+
+
+def fetch_job(task_id, job, dest_path):
+    """Download a job, fetching it again when the checksum doesn't match."""
+    current_module.set(job["module"])
+    for attempt in refetch_attempts(task_id):
+        accepted = None
+        if not attempt and delta_updates and job["seed"]:
+            accepted = copy_delta(task_id, job, dest_path)
+        if accepted is None and not done_event.is_set():
+            accepted = copy_from_mirrors(task_id, job, dest_path)
+        if accepted is not False:
+            return accepted
+    return False
+
+
+active_downloads = set()
+# files accepted since the download workers were started, guarded by the same lock
+finished_downloads = set()
+active_downloads_lock = Lock()
+
+
+def claim_download(job):
+    """Return the file a job downloads to, None if it must not be downloaded now."""
     if BLOCK_DOWNLOAD:
-        print("Downloads blocked through settings")
-        print("Usually because of testing purposes")
-        print(urls)
-        print(dest_dirs)
-        return
+        progress.console.log(f"Download blocked through settings: {job['url']} -> {job['dest_dir']}")
+        return None
+
+    if not exists(job["dest_dir"]):
+        os.makedirs(job["dest_dir"], exist_ok=True)
+
+    dest_path = os.path.join(job["dest_dir"], job["url"].split("/")[-1])
+    with active_downloads_lock:
+        # two modules resolving to the same file must not write the same .part,
+        # nor download it again once the first one is done
+        if dest_path in active_downloads or dest_path in finished_downloads:
+            return None
+        active_downloads.add(dest_path)
+    return dest_path
+
+
+def release_download(dest_path, accepted=None):
+    with active_downloads_lock:
+        active_downloads.discard(dest_path)
+        if accepted:
+            finished_downloads.add(dest_path)
+
+
+def download_worker(jobs):
+    """Download jobs from the priority queue until a None job arrives."""
+    while True:
+        job = jobs.get()[2]
+        if job is None:
+            return
+
+        dest_path = claim_download(job)
+        if dest_path is None:
+            continue
+
+        filename = os.path.basename(dest_path)
+        task_id = progress.add_task("download", filename=filename, start=False)
+        accepted = None
+        try:
+            accepted = fetch_job(task_id, job, dest_path)
+        except Exception as error:
+            progress.console.log(f"[bold red]Download of {filename} failed ({error})")
+        finally:
+            release_download(dest_path, accepted)
+
+
+# bytes received by the asyncio engine that the progress display hasn't seen yet
+progress_advances = {}
+
+
+def advance_progress(task_id, amount):
+    progress_advances[task_id] = progress_advances.get(task_id, 0) + amount
+
 
-    with progress:
-        with ThreadPoolExecutor(max_workers=max_simultaneous_downloads) as pool:
-            for url in urls:
-                dest_dir = dest_dirs[urls.index(url)]
+def flush_progress():
+    """Hand the batched byte counts of the asyncio engine to the progress display."""
+    for task_id in list(progress_advances):
+        progress.update(task_id, advance=progress_advances.pop(task_id))
 
-                if not exists(dest_dir):
-                    os.makedirs(dest_dir)
 
-                filename = url[0].split("/")[-1]
-                dest_path = os.path.join(dest_dir, filename)
-                task_id = progress.add_task("download", filename=filename, start=False)
-                pool.submit(copy_url, task_id, url[0], dest_path)
+async def refresh_progress():
+    import asyncio
+
+    while True:
+        await asyncio.sleep(PROGRESS_REFRESH)
+        flush_progress()
+
+
+async def async_open_resumable(session, url, part_path):
+    """Open url on an aiohttp session as resume_requests decides, returns like it."""
+    import aiohttp
+
+    steps = resume_requests(url, part_path)
+    headers = next(steps)
+    while True:
+        try:
+            response = await session.get(url, headers=headers)
+        except aiohttp.ClientResponseError as error:
+            headers = steps.throw(error)
+            continue
+        try:
+            headers = steps.send(response)
+        except StopIteration as done:
+            return done.value
+        response.release()
+
+
+async def async_copy_url(session, task_id, url, path, sha256=None, module=None):
+    """Copy a url to a local file like copy_url, on a pooled keep-alive connection.
+
+    Reads grow while the socket buffer keeps filling them and shrink when it
+    doesn't, so fast transfers cost few iterations and slow ones still show
+    progress. Returns like copy_url.
+    """
+    import asyncio
+
+    part_path = f"{path}{PART_SUFFIX}"
+    if part_complete(part_path):
+        return await asyncio.to_thread(finish_complete_part, task_id, part_path, path, sha256, module, url)
+
+    with timed("download_ttfb", server=url_host(url)):
+        response, offset, meta = await async_open_resumable(session, url, part_path)
+    try:
+        digest = await asyncio.to_thread(hash_file, part_path) if offset else hashlib.sha256()
+        size = ASYNC_READ_MIN
+        with part_writer(task_id, url, part_path, offset, meta) as (dest_file, transfer):
+            while data := await response.content.read(size):
+                write_chunk(dest_file, digest, transfer, data)
+                advance_progress(task_id, len(data))
+                if len(data) == size:
+                    size = min(size * 2, ASYNC_READ_MAX)
+                elif len(data) < size // 4:
+                    size = max(size // 2, ASYNC_READ_MIN)
+
+                wait = reserve_bandwidth(len(data))
+                if wait:
+                    await asyncio.sleep(wait)
+                if done_event.is_set():
+                    return None
+
+            check_received(dest_file.tell(), meta)
+            dest_file.flush()
+            await asyncio.to_thread(os.fsync, dest_file.fileno())
+    finally:
+        response.release()
+        progress.update(task_id, advance=progress_advances.pop(task_id, 0))
+
+    return finish_part(part_path, path, digest.hexdigest(), sha256, module, url)
+
+
+async def async_fetch_job(session, task_id, job, dest_path):
+    """Download a job like fetch_job on the asyncio engine.
+
+    Segmented downloads and delta updates are left to their thread based
+    implementation.
+    """
+    import asyncio
+
+    import aiohttp
+
+    part_path = f"{dest_path}{PART_SUFFIX}"
+    if job["segments"] > 1 or "segments" in read_part_meta(part_path) or (delta_updates and job["seed"]):
+        return await asyncio.to_thread(fetch_job, task_id, job, dest_path)
+
+    for attempt in refetch_attempts(task_id):
+        for url in job["urls"]:
+            try:
+                accepted = await async_copy_url(session, task_id, url, dest_path, job["sha256"], job["module"])
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) + MIRROR_ERRORS as error:
+                if done_event.is_set():
+                    return None
+                mirror_failed(url, error)
+        else:
+            progress.console.log(f"[bold red]Incomplete download, will resume next time: {dest_path}")
+            return None
+
+        if accepted is not False:
+            return accepted
+    return False
+
+
+async def async_download(session, job):
+    dest_path = claim_download(job)
+    if dest_path is None:
+        return
+
+    current_module.set(job["module"])
+    filename = os.path.basename(dest_path)
+    task_id = progress.add_task("download", filename=filename, start=False)
+    accepted = None
+    try:
+        accepted = await async_fetch_job(session, task_id, job, dest_path)
+    except Exception as error:
+        progress.console.log(f"[bold red]Download of {filename} failed ({error})")
+    finally:
+        release_download(dest_path, accepted)
+
+
+async def async_download_engine(jobs):
+    """Download jobs from the priority queue on one event loop until a None job arrives.
+
+    All transfers share one aiohttp session, so connections to a mirror are
+    kept alive and reused by the next file from the same host.
+    """
+    import asyncio
+
+    import aiohttp
+
+    slots = asyncio.Semaphore(max_simultaneous_downloads)
+    running = set()
+    connector = aiohttp.TCPConnector(limit=max_simultaneous_downloads, limit_per_host=max_connections_per_server,
+                                     keepalive_timeout=HTTP_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+    refresher = asyncio.create_task(refresh_progress())
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=True,
+                                     auto_decompress=False, read_bufsize=ASYNC_READ_MAX) as session:
+        while True:
+            # only take the next job once a slot is free so the queue order still applies
+            await slots.acquire()
+            job = (await asyncio.to_thread(jobs.get))[2]
+            if job is None:
+                break
+            task = asyncio.create_task(async_download(session, job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+        await asyncio.gather(*running)
+    refresher.cancel()
+    flush_progress()
+
+
+def start_download_workers(downloads, jobs):
+    """Start the consumers of the download queue on the configured engine."""
+    with active_downloads_lock:
+        finished_downloads.clear()
+
+    if download_engine == "asyncio":
+        if importlib.util.find_spec("aiohttp") is None:
+            progress.console.log("[bold yellow]download_engine = asyncio needs aiohttp, downloading with threads")
+        else:
+            import asyncio
+
+            downloads.submit(asyncio.run, async_download_engine(jobs))
+            return
+
+    for _ in range(max_simultaneous_downloads):
+        downloads.submit(download_worker, jobs)
 
 
 def read_conf(name):
@@ -133,12 +1242,152 @@ def read_conf(name):
     return lines
 
 
+class Module(NamedTuple):
+    name: str
+    category: str
+    server: str
+    cwd: str
+    options: str
+    description: str = ""
+    mirrors: list = []
+    segments: Optional[int] = None
+    priority: int = 0
+
+
+def parse_module(name, lines):
+    conf = parse_conf(lines)
+    return Module(
+        name=name,
+        category=conf["category"],
+        server=conf["server"],
+        cwd=conf["cwd"],
+        options=conf.get("options", "0"),
+        description=conf.get("description", ""),
+        mirrors=[host.strip() for host in conf.get("mirrors", "").split(",") if host.strip()],
+        segments=int(conf["segments"]) if "segments" in conf else None,
+        priority=int(conf.get("priority", 0)),
+    )
+
+
+catalog = {}
+
+
+def get_catalog():
+    """Return {name: Module} of every module file.
+
+    The parsed modules are cached in .iso-manager/catalog.json together with
+    the mtime of their file, only new or changed files are parsed again. The
+    cache also keeps the mtime of this script, a changed Module or parser
+    throws every parsed module away.
+    """
+    if catalog:
+        return catalog
+
+    state = load_state("catalog.json")
+    script = os.stat(__file__).st_mtime_ns
+    cached = state["modules"] if state.get("script") == script else {}
+    compiled = {}
+    with os.scandir(MODULE_PATH) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if not entry.name.endswith(".conf"):
+                continue
+            name = entry.name[:-len(".conf")]
+            mtime = entry.stat().st_mtime_ns
+            if name in cached and cached[name]["mtime"] == mtime:
+                compiled[name] = cached[name]
+            else:
+                compiled[name] = {"mtime": mtime, "module": parse_module(name, read_conf(name))._asdict()}
+
+    if compiled != cached:
+        save_state("catalog.json", {"script": script, "modules": compiled})
+    catalog.update({name: Module(**record["module"]) for name, record in compiled.items()})
+    return catalog
+
+
 def create_download_link(server, cwd, filename):
-    link = f"https://{server}{cwd}/{filename}"
+    link = f"{HTTP_SCHEME}://{server}{cwd}/{filename}"
     return link
 
 
-def ubuntu_model_manager(server, cwd, options, ftp, entries, version):
+ftp_pool = {}
+ftp_pool_lock = Lock()
+ftp_listings = {}
+ftp_listing_locks = {}
+
+
+def ftp_acquire(server):
+    """Take an idle logged-in connection to a server from the pool or open a new one."""
+    import ftplib
+
+    with ftp_pool_lock:
+        idle = ftp_pool.setdefault(server, [])
+        if idle:
+            return idle.pop(), True
+
+    with timed("ftp_login", server=server):
+        # the module server may carry the port of its web server, the listing always comes from FTP_PORT
+        ftp = ftplib.FTP(timeout=FTP_TIMEOUT)
+        ftp.connect(urlsplit(f"//{server}").hostname, FTP_PORT)
+        ftp.login()
+    return ftp, False
+
+
+def ftp_release(server, ftp):
+    with ftp_pool_lock:
+        ftp_pool.setdefault(server, []).append(ftp)
+
+
+def ftp_close_all():
+    """Close every pooled connection and forget the listings of this run."""
+    import ftplib
+
+    with ftp_pool_lock:
+        for connections in ftp_pool.values():
+            for ftp in connections:
+                try:
+                    ftp.quit()
+                except (OSError, EOFError, ftplib.Error):
+                    ftp.close()
+        ftp_pool.clear()
+        ftp_listings.clear()
+        ftp_listing_locks.clear()
+
+
+def ftp_list(server, path):
+    """Return the listing of a directory, fetching it at most once per run."""
+    import ftplib
+
+    key = (server, path)
+    with ftp_pool_lock:
+        listing_lock = ftp_listing_locks.setdefault(key, Lock())
+
+    with listing_lock:
+        if key in ftp_listings:
+            return ftp_listings[key]
+
+        while True:
+            ftp, reused = ftp_acquire(server)
+            try:
+                with timed("ftp_nlst", server=server, path=path):
+                    ftp.cwd(path)
+                    entries = ftp.nlst()
+                break
+            except (OSError, EOFError, ftplib.error_temp, ftplib.error_reply):
+                ftp.close()
+                # pooled connections may have been dropped by the server while idle
+                if not reused:
+                    raise
+                record_metric("ftp_reconnect", 0, server=server)
+            except ftplib.Error:
+                ftp.close()
+                raise
+
+        ftp_release(server, ftp)
+        ftp_listings[key] = entries
+        return entries
+
+
+def ubuntu_model_manager(server, cwd, options, entries, version):
     regex = re.compile("[0-9][0-9].[0-9][0-9]?.?[0-9]?[0-9]")
     versions = []
     up_to_date_version = -1
@@ -147,14 +1396,12 @@ def ubuntu_model_manager(server, cwd, options, ftp, entries, version):
         if regex.match(entry):
             versions.append(entry)
     if version == 0:
-        ftp.cwd(cwd + f"/{versions[up_to_date_version]}")
+        newest_entries = ftp_list(server, cwd + f"/{versions[up_to_date_version]}")
     elif version == 1 or version == 2:
-        ftp.cwd(cwd + f"/{versions[up_to_date_version]}")
-        if not ("release" in ftp.nlst()):
+        if not ("release" in ftp_list(server, cwd + f"/{versions[up_to_date_version]}")):
             up_to_date_version = -2
-        ftp.cwd(cwd + f"/{versions[up_to_date_version]}/release")
+        newest_entries = ftp_list(server, cwd + f"/{versions[up_to_date_version]}/release")
 
-    newest_entries = ftp.nlst()
     for new_entry in newest_entries:
         if "-" in new_entry:
             if version == 0 or version == 1:
@@ -170,72 +1417,176 @@ def ubuntu_model_manager(server, cwd, options, ftp, entries, version):
         return create_download_link(server, f"{cwd}/{versions[up_to_date_version]}/release", files[int(options)])
 
 
+listing_cache = {}
+# keys asked for this run, and a lock per key so modules sharing a listing fetch it once
+listings_checked = set()
+listing_locks = {}
+listing_cache_lock = Lock()
+
+
+def load_listing_cache():
+    with listing_cache_lock:
+        listing_cache.clear()
+        listing_cache.update(load_state("listings.json"))
+        listings_checked.clear()
+        listing_locks.clear()
+
+
+def save_listing_cache():
+    with listing_cache_lock:
+        save_state("listings.json", listing_cache)
+
+
+class LinkExtractor(HTMLParser):
+    """Collect the hrefs of <a> tags from an index page fed in pieces.
+
+    Only links accepted by keep are stored, so memory stays at one chunk of
+    the page plus the matching links however large the listing is.
+    """
+
+    def __init__(self, keep=None):
+        super().__init__()
+        self.keep = keep
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        for name, value in attrs:
+            if name == "href" and value is not None and (self.keep is None or self.keep(value)):
+                self.links.append(value)
+
+
+def is_build_dir(href):
+    return re.match("[0-9][0-9][0-9][0-9][0-9][0-9]/", href) is not None
+
+
+def is_release_dir(href):
+    return re.match("[0-9][0-9]?.?[0-9]", href) is not None
+
+
+def is_iso(href):
+    return href.split(".")[-1] == "iso"
+
+
+def is_amd64_iso(href):
+    return href.split("-")[-1] == "amd64.iso"
+
+
+def is_manjaro_download(href):
+    return "download" in href and "manjaro" in href
+
+
+def extract_links(response, keep=None):
+    """Stream a response through a LinkExtractor and return the links kept."""
+    parser = LinkExtractor(keep)
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    for chunk in response.iter_content(chunk_size=LISTING_CHUNK):
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    return parser.links
+
+
+def http_links(url, keep=None, revalidate=False):
+    """Return the hrefs of an index page that pass the keep filter.
+
+    Cached listings younger than listing_cache_ttl are used as they are, older
+    ones are revalidated with ETag/Last-Modified so an unchanged page costs a 304.
+    revalidate asks the server even when the cached listing is still young.
+    Either way a page is only requested once per run.
+    """
+    key = f"{url}#{keep.__name__}" if keep else url
+    with listing_cache_lock:
+        listing_lock = listing_locks.setdefault(key, Lock())
+
+    with listing_lock:
+        with listing_cache_lock:
+            cached = listing_cache.get(key)
+            if cached and key in listings_checked:
+                return cached["links"]
+            if refresh_listings:
+                cached = None
+
+        if cached and not revalidate and time.time() - cached["checked"] < listing_cache_ttl:
+            return cached["links"]
+        return fetch_listing(url, keep, key, cached)
+
+
+def fetch_listing(url, keep, key, cached):
+    """Fetch an index page for http_links, revalidating the cached listing if there is one."""
+    import requests
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    server = url_host(url)
+    with timed("http_fetch", server=server) as fields, \
+            requests.get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as fp:
+        # elapsed stops when the headers are in, the body is streamed afterwards
+        record_metric("http_ttfb", fp.elapsed.total_seconds(), server=server)
+        fields["status"] = fp.status_code
+        if cached and fp.status_code == 304:
+            links = cached["links"]
+        else:
+            fp.raise_for_status()
+            with timed("parse", server=server):
+                links = extract_links(fp, keep)
+            cached = {}
+        fields["bytes"] = fp.raw.tell()
+
+    with listing_cache_lock:
+        if not cached:
+            # the page changed, the views other keep filters cached of it are stale too
+            for other in [other for other in listing_cache if other.split("#")[0] == url]:
+                del listing_cache[other]
+        listing_cache[key] = {
+            "links": links,
+            "etag": fp.headers.get("ETag", cached.get("etag")),
+            "last_modified": fp.headers.get("Last-Modified", cached.get("last_modified")),
+            "checked": time.time(),
+        }
+        listings_checked.add(key)
+    return links
+
+
 def http_traverse(os_name, server, cwd, options):
     options = int(options.strip())
     download_links = []
     if "garuda" in os_name:
         forward_link = ""
-        object = []
-        fp = requests.get(f"https://{server}{cwd}")
-        # print(fp)
-        soup = BeautifulSoup(fp.content, 'html.parser')
-        regex = re.compile("[0-9][0-9][0-9][0-9][0-9][0-9]/")
-        for link in soup.find_all("a", href=True):
-            if regex.match(link["href"]):
-                object.append(link["href"])
-
-        # print(object)
+        object = http_links(f"{HTTP_SCHEME}://{server}{cwd}", is_build_dir)
 
         forward_link += str(object[-1])
-        new_link = f"https://{server}{cwd}/{forward_link}"
-        fp = requests.get(new_link)
-        soup = BeautifulSoup(fp.content, 'html.parser')
+        new_link = f"{HTTP_SCHEME}://{server}{cwd}/{forward_link}"
         file = ""
-        for link in soup.find_all("a", href=True):
-            if link["href"].split(".")[-1] == "iso":
-                file = link["href"]
+        for href in http_links(new_link, is_iso):
+            file = href
 
         download_links.append(f"{new_link}/{file}")
 
     elif "kali" in os_name:
-        fp = requests.get(f"https://{server}{cwd}")
-        soup = BeautifulSoup(fp.content, 'html.parser')
-        new_link = f"https://{server}{cwd}"
-        files = []
-        for link in soup.find_all("a", href=True):
-            if link["href"].split("-")[-1] == "amd64.iso":
-                files.append(link["href"])
+        new_link = f"{HTTP_SCHEME}://{server}{cwd}"
+        files = http_links(new_link, is_amd64_iso)
 
         download_links.append(f"{new_link}/{files[options]}")
 
     elif "mint" in os_name:
         forward_link = ""
-        object = []
-        fp = requests.get(f"https://{server}{cwd}")
-        soup = BeautifulSoup(fp.content, 'html.parser')
-        regex = re.compile("[0-9][0-9]?.?[0-9]")
-        for link in soup.find_all("a", href=True):
-            if regex.match(link["href"]):
-                object.append(link["href"])
+        object = http_links(f"{HTTP_SCHEME}://{server}{cwd}", is_release_dir)
         forward_link += str(object[-1])
-        new_link = f"https://{server}{cwd}/{forward_link}"
-        fp = requests.get(new_link)
-        soup = BeautifulSoup(fp.content, 'html.parser')
-        files = []
-        for link in soup.find_all("a", href=True):
-            if link["href"].split(".")[-1] == "iso":
-                files.append(link["href"])
+        new_link = f"{HTTP_SCHEME}://{server}{cwd}/{forward_link}"
+        files = http_links(new_link, is_iso)
 
         download_links.append(f"{new_link}/{files[options]}")
 
     elif "manjaro" in os_name:
         forward_link = ""
-        object = []
-        fp = requests.get(f"https://{server}{cwd}")
-        soup = BeautifulSoup(fp.content, 'html.parser')
-        for link in soup.find_all("a", href=True):
-            if "download" in link["href"] and "manjaro" in link["href"]:
-                object.append(link["href"])
+        object = http_links(f"{HTTP_SCHEME}://{server}{cwd}", is_manjaro_download)
 
         forward_link += str(object[options])
         download_links.append(forward_link)
@@ -244,24 +1595,17 @@ def http_traverse(os_name, server, cwd, options):
 
 
 def ftp_traverse(os_name, server, cwd, options):
-    ftp = ftplib.FTP(server)
-    ftp.login()
-    ftp.cwd(cwd)
-    try:
-        entries = ftp.nlst()
-    except:
-        print(f"timeout on {server}{cwd}")
-        return ""
+    entries = ftp_list(server, cwd)
     return_files = []
     match os_name:
         case "ubuntu" | "ubuntu-server":
-            return_files.append(ubuntu_model_manager(server, cwd, options, ftp, entries, 0))
+            return_files.append(ubuntu_model_manager(server, cwd, options, entries, 0))
 
         case "edubuntu" | "ubuntu-cinnamon" | "lubuntu" | "kubuntu" | "xubuntu" | "xubuntu-minimal"| "ubuntu-studio":
-            return_files.append(ubuntu_model_manager(server, cwd, options, ftp, entries, 1))
+            return_files.append(ubuntu_model_manager(server, cwd, options, entries, 1))
 
         case "ubuntu-budgie" | "ubuntu-unity" | "ubuntu-mate":
-            return_files.append(ubuntu_model_manager(server, cwd, options, ftp, entries, 2))
+            return_files.append(ubuntu_model_manager(server, cwd, options, entries, 2))
 
         case "arch":
             regex = re.compile("[0-9][0-9][0-9][0-9].[0-9][0-9].[0-9][0-9]")
@@ -275,61 +1619,891 @@ def ftp_traverse(os_name, server, cwd, options):
     return return_files
 
 
+server_slots = {}
+server_slots_lock = Lock()
+
+
+def server_slot(server):
+    """Return the semaphore limiting concurrent connections to a server."""
+    with server_slots_lock:
+        if server not in server_slots:
+            server_slots[server] = BoundedSemaphore(max_connections_per_server)
+        return server_slots[server]
+
+
+checksums = {}
+checksum_lists = {}
+checksum_list_locks = {}
+checksum_lists_lock = Lock()
+
+
+def read_checksum_list(url):
+    """Return {filename: sha256} of a published checksum file, fetched once per run."""
+    import requests
+
+    with checksum_lists_lock:
+        list_lock = checksum_list_locks.setdefault(url, Lock())
+
+    with list_lock:
+        if url in checksum_lists:
+            return checksum_lists[url]
+
+        sums = {}
+        with timed("checksum_list", server=url_host(url)) as fields:
+            fp = requests.get(url, timeout=HTTP_TIMEOUT)
+            fields["bytes"] = len(fp.content)
+        if fp.ok:
+            for line in fp.text.splitlines():
+                parts = line.split()
+                if len(parts) >= 2 and len(parts[0]) == 64:
+                    sums[parts[-1].lstrip("*").split("/")[-1]] = parts[0].lower()
+        checksum_lists[url] = sums
+        return sums
+
+
+def fetch_checksum(category, link):
+    """Look up the published sha256 of a resolved download link."""
+    import requests
+
+    directory, filename = link.rsplit("/", 1)
+    if category in CHECKSUM_FILES:
+        sums_url = f"{directory}/{CHECKSUM_FILES[category]}"
+    else:
+        sums_url = f"{link}.sha256"
+
+    try:
+        return read_checksum_list(sums_url).get(filename)
+    except requests.RequestException:
+        return None
+
+
+mirror_scores = {}
+mirror_scores_lock = Lock()
+mirror_links = {}
+
+
+def module_mirrors(module):
+    """Return the main server of a module followed by its extra mirrors."""
+    hosts = [module.server]
+    for host in module.mirrors:
+        if host not in hosts:
+            hosts.append(host)
+    return hosts
+
+
+def mirror_url(link, server, host):
+    return link.replace(f"//{server}/", f"//{host}/", 1)
+
+
+def ordered_mirrors(hosts):
+    """Sort hosts by their last measured score, unknown and failing ones last."""
+    def score(host):
+        entry = mirror_scores.get(host)
+        return entry["score"] if entry and entry["score"] is not None else float("inf")
+
+    with mirror_scores_lock:
+        return sorted(hosts, key=score)
+
+
+def probe_mirror(url):
+    """Return the seconds needed to fetch the first mirror_sample_bytes of url, None if it fails.
+
+    The time covers both the latency until the first byte and the throughput of the sample.
+    """
+    start = time.monotonic()
+    try:
+        with timed("mirror_probe", server=url_host(url)) as fields:
+            response = urlopen(Request(url, headers={"Range": f"bytes=0-{mirror_sample_bytes - 1}"}), timeout=MIRROR_PROBE_TIMEOUT)
+            with response:
+                fields["bytes"] = len(response.read(mirror_sample_bytes))
+    except (OSError, http.client.HTTPException):
+        return None
+    return time.monotonic() - start
+
+
+def rank_mirrors(hosts, link, server):
+    """Probe the mirrors whose ranking expired with a ranged sample of link and return them best first."""
+    with mirror_scores_lock:
+        stale = [host for host in hosts
+                 if time.time() - mirror_scores.get(host, {}).get("checked", 0) > mirror_ranking_ttl]
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+            # every probe runs in a copy of this context so its metric keeps the module
+            futures = [pool.submit(contextvars.copy_context().run, probe_mirror, mirror_url(link, server, host))
+                       for host in stale]
+            scores = [future.result() for future in futures]
+        with mirror_scores_lock:
+            for host, score in zip(stale, scores):
+                mirror_scores[host] = {"score": score, "checked": time.time()}
+
+    return ordered_mirrors(hosts)
+
+
+def load_mirror_scores():
+    with mirror_scores_lock:
+        mirror_scores.clear()
+        mirror_scores.update(load_state("mirrors.json"))
+
+
+def save_mirror_scores():
+    with mirror_scores_lock:
+        save_state("mirrors.json", mirror_scores)
+
+
+def resolve_on(module, server):
+    """Resolve the download links of a module on one of its servers."""
+    with server_slot(server):
+        if module.category in HTTP_CATEGORIES:
+            links = http_traverse(module.name, server, module.cwd, module.options)
+        else:
+            links = ftp_traverse(module.name, server, module.cwd, module.options)
+
+        if not links or not links[0]:
+            raise RuntimeError(f"no download link found on {server}{module.cwd}")
+        if verify_checksums:
+            checksums[links[0]] = fetch_checksum(module.category, links[0])
+    return links
+
+
+def resolve_module(module):
+    """Resolve the download links of a single module.
+
+    Mirrors are tried best first until one resolves. The resolved file is then
+    sampled on every mirror to rank them for the download, see mirror_links.
+    """
+    current_module.set(module.name)
+    with timed("resolve"):
+        hosts = ordered_mirrors(module_mirrors(module))
+        for host in hosts:
+            try:
+                links = resolve_on(module, host)
+                break
+            except Exception as error:
+                if host == hosts[-1]:
+                    raise
+                record_metric("resolve_retry", 0, server=host, error=type(error).__name__)
+
+        if len(hosts) > 1 and f"//{host}/" in links[0]:
+            ranked = rank_mirrors(hosts, links[0], host)
+            mirror_links[links[0]] = [mirror_url(links[0], host, mirror) for mirror in ranked]
+    return links
+
+
+def resolve_modules(modules, console):
+    """Resolve all modules in parallel, keeping the order of the given list.
+
+    Failed modules are logged and reported as None instead of aborting the batch.
+    """
+    results = [None] * len(modules)
+    with ThreadPoolExecutor(max_workers=max(1, min(RESOLVE_WORKERS, len(modules)))) as pool:
+        futures = {pool.submit(resolve_module, module): index for index, module in enumerate(modules)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+                console.log(f"Completed file: {modules[index].name}")
+            except Exception as error:
+                console.log(f"[bold red]Failed file: {modules[index].name} ({error})")
+
+    return results
+
+
+def start_resolution():
+    load_listing_cache()
+    load_mirror_scores()
+
+
+def finish_resolution():
+    ftp_close_all()
+    save_listing_cache()
+    checksum_lists.clear()
+    checksum_list_locks.clear()
+    save_mirror_scores()
+
+
+def remote_size(url):
+    """Return the Content-Length of url from a HEAD request, None if unknown."""
+    try:
+        with timed("http_head", server=url_host(url)), urlopen(Request(url, method="HEAD"), timeout=HTTP_TIMEOUT) as response:
+            length = response.headers.get("Content-Length")
+    except (OSError, http.client.HTTPException):
+        return None
+    return int(length) if length else None
+
+
+def previous_download(module):
+    """Return the path of the last file retired to old/ for a module, if any."""
+    with manifest_lock:
+        history = load_state("manifest.json").get(module, {}).get("history")
+    if history:
+        return os.path.join(download_path, history[-1]["path"])
+    return None
+
+
+def make_job(module, links):
+    urls = mirror_links.pop(links[0], links[:1])
+    if lan_cache:
+        # a LAN cache keeps the library layout, a miss is a 404 and the next mirror is tried
+        urls = [f"{lan_cache}/{module.category}/{links[0].split('/')[-1]}"] + urls
+    return {
+        "module": module.name,
+        "url": links[0],
+        "urls": urls,
+        "dest_dir": f"{download_path}/{module.category}",
+        "segments": module.segments or segments_per_download,
+        "sha256": checksums.get(links[0]),
+        "priority": module.priority,
+        "size": None,
+        "seed": previous_download(module.name),
+    }
+
+
+def resolve_job(module):
+    """Resolve a module into a download job and look up the size of its file."""
+    job = make_job(module, resolve_module(module))
+    if download_order == "largest":
+        for url in job["urls"]:
+            job["size"] = remote_size(url)
+            if job["size"] is not None:
+                break
+    return job
+
+
+def job_order(job):
+    """Sort key of a job in the download queue, smallest goes first.
+
+    download_order = largest starts the biggest files first so the run ends
+    with small ones filling the slots, priority follows the priority value of
+    the modules (higher first) and module keeps the resolve order.
+    """
+    if download_order == "largest":
+        return -(job["size"] or 0)
+    if download_order == "priority":
+        return -job["priority"]
+    return 0
+
+
+def download_pipeline(modules):
+    """Resolve modules and download them, each module is queued as soon as its link is known.
+
+    Returns the names of the modules that couldn't be resolved.
+    """
+    from rich.console import Group
+    from rich.live import Live
+    from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
+
+    download_progress()
+    failed = []
+    jobs = PriorityQueue()
+    queued = 0
+    resolving = Progress(SpinnerColumn(), TextColumn("[bold green]{task.description}"), TimeElapsedColumn())
+
+    with Live(Group(resolving, progress), console=progress.console):
+        with ThreadPoolExecutor(max_workers=max_simultaneous_downloads) as downloads:
+            start_download_workers(downloads, jobs)
+
+            start_resolution()
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, min(RESOLVE_WORKERS, len(modules)))) as resolvers:
+                    futures = {}
+                    for module in modules:
+                        task_id = resolving.add_task(f"Resolving {module.name}")
+                        futures[resolvers.submit(resolve_job, module)] = (module, task_id)
+
+                    for future in as_completed(futures):
+                        module, task_id = futures[future]
+                        resolving.remove_task(task_id)
+                        try:
+                            job = future.result()
+                            queued += 1
+                            jobs.put((job_order(job), queued, job))
+                            progress.console.log(f"Completed file: {module.name}")
+                        except Exception as error:
+                            failed.append(module.name)
+                            progress.console.log(f"[bold red]Failed file: {module.name} ({error})")
+            finally:
+                finish_resolution()
+                for worker in range(max_simultaneous_downloads):
+                    jobs.put((float("inf"), worker, None))
+
+    return failed
+
+
 def update(os_list, check_version=False):
+    from rich.console import Console
+
     file = []
-    os_objects = []
-    categories = []
+    resolved = []
     download_paths = []
 
-    for os_entry in os_list:
-        temp = read_conf(os_entry)
-        for line in temp:
-            temp[temp.index(line)] = line.split('= ')[1].strip()
+    modules = [get_catalog()[os_entry] for os_entry in os_list]
 
-        temp.insert(0, os_entry)
-        os_objects.append(temp)
+    start_metrics()
+    console = Console()
+    if not check_version:
+        failed = download_pipeline(modules)
+    else:
+        start_resolution()
+        with console.status("[bold green]Compiling files...") as status:
+            try:
+                results = resolve_modules(modules, console)
+            finally:
+                finish_resolution()
+
+        failed = []
+        for module, links in zip(modules, results):
+            if links is None:
+                failed.append(module.name)
+                continue
+            file.append(links)
+            resolved.append(module.name)
+            download_paths.append(f"{download_path}/{module.category}")
+
+    if failed:
+        console.log(f"[bold red]Could not resolve {len(failed)} module(s): {', '.join(failed)}")
+    write_metrics()
+
+    if check_version:
+        return [file, download_paths, resolved]
+
+
+def hash_iso(path):
+    """Hash a whole image through a read-only memory map."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, "madvise"):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(data)
+            for offset in range(0, len(data), VERIFY_CHUNK):
+                digest.update(view[offset:offset + VERIFY_CHUNK])
+            view.release()
+    return digest.hexdigest()
+
+
+def library_isos():
+    """Yield the path of every ISO in the category folders, including old/."""
+    for category in os.listdir(download_path):
+        if category.startswith(".") or not os.path.isdir(f"{download_path}/{category}"):
+            continue
+        for root, dirs, files in os.walk(f"{download_path}/{category}"):
+            dirs[:] = [folder for folder in dirs if folder != "quarantine"]
+            for file in files:
+                if file.endswith(".iso"):
+                    yield os.path.join(root, file)
+
+
+def verify_library():
+    """Hash every ISO of the library on all cores and compare with the known checksums.
+
+    Results are kept in .iso-manager/verify.json, files whose size and mtime
+    didn't change since the last run are not hashed again.
+    """
+    from rich.console import Console
 
     console = Console()
-    with console.status("[bold green]Compiling files...") as status:
-        for object in os_objects:
-            object_index = os_objects.index(object)
+    results = load_state("verify.json")
+    known = load_state("checksums.json")
+    pending = {}
+
+    for path in library_isos():
+        stat = os.stat(path)
+        key = os.path.relpath(path, download_path)
+        cached = results.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+            continue
+        pending[key] = (path, stat)
+
+    with console.status(f"[bold green]Hashing {len(pending)} file(s)..."):
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            futures = {pool.submit(hash_iso, path): key for key, (path, stat) in pending.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                path, stat = pending[key]
+                try:
+                    sha256 = future.result()
+                except OSError as error:
+                    console.log(f"[bold red]Could not read {key} ({error})")
+                    continue
+                results[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": sha256}
+                console.log(f"Hashed file: {key}")
+
+    library = set(os.path.relpath(path, download_path) for path in library_isos())
+    for key in list(results):
+        if key not in library:
+            del results[key]
+            continue
+        expected = known.get(os.path.basename(key))
+        if expected is None:
+            results[key]["status"] = "unknown"
+        else:
+            results[key]["status"] = "ok" if expected == results[key]["sha256"] else "mismatch"
+
+    save_state("verify.json", results)
+
+    for key in sorted(results):
+        if results[key]["status"] == "mismatch":
+            console.log(f"[bold red]Checksum mismatch: {key}")
+    statuses = [entry["status"] for entry in results.values()]
+    console.log(f"{len(statuses)} file(s), {len(pending)} hashed: {statuses.count('ok')} ok, "
+                f"{statuses.count('mismatch')} mismatched, {statuses.count('unknown')} without a reference checksum")
+    return results
+
+
+def dedup_library():
+    """Move every ISO of the library into the content store, linking duplicates to one copy."""
+    from rich.console import Console
 
-            http_list = ["garuda", "kali", "mint", "manjaro"]
+    console = Console()
+    results = verify_library()
+    saved = 0
+    for key, result in results.items():
+        path = os.path.join(download_path, key)
+        target = store_object(result["sha256"])
+        if exists(target) and os.path.samefile(path, target):
+            continue
+        if exists(target):
+            saved += result["size"]
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            if not exists(target):
+                os.link(path, target)
+            else:
+                link_from_store(result["sha256"], path)
+        except OSError as error:
+            console.log(f"[bold red]Could not deduplicate {key} ({error})")
+
+    saved += prune_store()
+    console.log(f"Deduplicated library, {saved / 1024 ** 3:.2f} GiB freed")
+
+
+def scan_old(category):
+    """Return (path, stat) of every file in the old folder of a category."""
+    old_dir = os.path.join(download_path, category, "old")
+    if not os.path.isdir(old_dir):
+        return []
+    with os.scandir(old_dir) as entries:
+        return [(entry.path, entry.stat()) for entry in entries if entry.is_file(follow_symlinks=False)]
+
+
+def retention_plan(old_files, manifest):
+    """Pick the old files to delete, returns {path: reason}.
+
+    Keeps the retention_keep newest retired files of each module, drops files
+    older than retention_max_age_days and then evicts the least recently used
+    files until all old folders fit into retention_max_old_size.
+    """
+    retired = {}
+    for module, entry in manifest.items():
+        for version in entry.get("history", []):
+            retired[os.path.join(download_path, version["path"])] = (module, version["retired"])
+
+    def retired_at(path):
+        return retired[path][1] if path in retired else old_files[path].st_mtime
+
+    plan = {}
+    if retention_keep:
+        per_module = {}
+        for path in old_files:
+            if path in retired:
+                per_module.setdefault(retired[path][0], []).append(path)
+        for module, paths in per_module.items():
+            for path in sorted(paths, key=retired_at, reverse=True)[retention_keep:]:
+                plan[path] = f"more than {retention_keep} old versions of {module}"
+
+    if retention_max_age_days:
+        limit = time.time() - retention_max_age_days * 86400
+        for path in old_files:
+            if path not in plan and retired_at(path) < limit:
+                plan[path] = f"older than {retention_max_age_days} days"
+
+    if retention_max_old_size:
+        kept = [path for path in old_files if path not in plan]
+        total = sum(old_files[path].st_size for path in kept)
+        for path in sorted(kept, key=lambda path: old_files[path].st_atime):
+            if total <= retention_max_old_size:
+                break
+            plan[path] = "over the old/ size budget"
+            total -= old_files[path].st_size
+
+    return plan
+
+
+def cleanup_old_files(dry_run=True):
+    """Apply the retention policy to the old folders of all categories.
+
+    With dry_run the files that would be deleted are only reported.
+    """
+    from rich.console import Console
+    from rich.table import Table
 
-            if not os_objects[object_index][1] in http_list:
-                file.append(ftp_traverse(os_objects[object_index][0], os_objects[object_index][2], os_objects[object_index][3], os_objects[object_index][4]))
+    console = Console()
+    categories = [folder for folder in os.listdir(download_path)
+                  if not folder.startswith(".") and os.path.isdir(os.path.join(download_path, folder))]
+    with ThreadPoolExecutor(max_workers=max(1, min(RESOLVE_WORKERS, len(categories)))) as pool:
+        scans = dict(zip(categories, pool.map(scan_old, categories)))
+
+    old_files = {path: stat for scan in scans.values() for path, stat in scan}
+    with manifest_lock:
+        manifest = load_state("manifest.json")
+        plan = retention_plan(old_files, manifest)
+
+        if not dry_run:
+            for path in plan:
+                os.remove(path)
+            for entry in manifest.values():
+                entry["history"] = [version for version in entry.get("history", [])
+                                    if os.path.join(download_path, version["path"]) not in plan]
+            save_state("manifest.json", manifest)
+
+    table = Table(title="Old files (dry run)" if dry_run else "Old files")
+    table.add_column("Category")
+    table.add_column("Files", justify="right")
+    table.add_column("Size", justify="right")
+    table.add_column("Delete" if dry_run else "Deleted", justify="right")
+    for category, scan in sorted(scans.items()):
+        if scan:
+            table.add_row(category, str(len(scan)), f"{sum(stat.st_size for path, stat in scan) / 1024 ** 3:.2f} GiB",
+                          f"{sum(stat.st_size for path, stat in scan if path in plan) / 1024 ** 3:.2f} GiB")
+    console.print(table)
+
+    for path, reason in sorted(plan.items()):
+        console.log(f"{'Would delete' if dry_run else 'Deleted'} {os.path.relpath(path, download_path)}: {reason}")
+    if not dry_run and content_store:
+        prune_store()
+    return plan
+
+
+def listing_fingerprint(module):
+    """Hash the upstream listing of a module's cwd, None when it can't be fetched.
+
+    New releases show up there first, as a new version or build directory or
+    a new file name. Listings go through the same caches as the resolvers,
+    HTTP ones are always revalidated so the TTL can't hide a new release.
+    """
+    current_module.set(module.name)
+    try:
+        with server_slot(module.server):
+            if module.category in HTTP_CATEGORIES:
+                entries = http_links(f"{HTTP_SCHEME}://{module.server}{module.cwd}", revalidate=True)
             else:
-                file.append(http_traverse(os_objects[object_index][0], os_objects[object_index][2], os_objects[object_index][3], os_objects[object_index][4]))
-            categories.append(os_objects[object_index][1])
-            console.log(f"Completed file: {os_objects[object_index][0]}")
+                entries = ftp_list(module.server, module.cwd)
+    except Exception:
+        return None
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+
+def has_file(manifest, module, url):
+    """Tell whether the file of url is the current download of a module and still on disk.
+
+    Files from before the manifest existed are recorded on the way, a
+    matching one as the current download and otherwise an older release.
+    """
+    entry = manifest.get(module.name)
+    filename = url.split("/")[-1]
+    path = f"{download_path}/{module.category}/{filename}"
+    if entry is None and exists(path):
+        record_download(module.name, path, url, None)
+        return True
+    if entry is None:
+        adopt_download(module.name, module.category, filename)
+        return False
+    return bool(entry and entry["file"] == filename and exists(os.path.join(download_path, entry["path"])))
+
+
+def download_jobs(jobs):
+    """Download prepared jobs without the live display."""
+    queue = PriorityQueue()
+    for index, job in enumerate(jobs):
+        queue.put((job_order(job), index, job))
+    for worker in range(max_simultaneous_downloads):
+        queue.put((float("inf"), worker, None))
+
+    download_progress()
+    with ThreadPoolExecutor(max_workers=max_simultaneous_downloads) as downloads:
+        start_download_workers(downloads, queue)
+
+
+def run_sync(modules, console):
+    """Bring modules up to date and return {name: status}."""
+    state = load_state("sync_state.json")
+    manifest = load_state("manifest.json")
+    now = time.time()
+    statuses = {}
+    jobs = []
+
+    due = []
+    for module in modules:
+        entry = state.get(module.name, {})
+        if (not refresh_listings and now - entry.get("checked", 0) < sync_interval
+                and entry.get("url") and has_file(manifest, module, entry["url"])):
+            statuses[module.name] = "fresh"
+        else:
+            due.append(module)
+
+    start_resolution()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(RESOLVE_WORKERS, len(due)))) as pool:
+            fingerprints = list(pool.map(listing_fingerprint, due))
+
+        changed = []
+        missing = []
+        for module, fingerprint in zip(due, fingerprints):
+            entry = state.setdefault(module.name, {})
+            if refresh_listings or fingerprint is None or fingerprint != entry.get("fingerprint") or not entry.get("url"):
+                changed.append((module, fingerprint))
+                continue
+            entry["checked"] = now
+            if has_file(manifest, module, entry["url"]):
+                statuses[module.name] = "unchanged"
+            else:
+                # nothing moved upstream, but the last download didn't finish
+                checksums[entry["url"]] = entry.get("sha256")
+                missing.append((module, [entry["url"]]))
+
+        results = resolve_modules([module for module, fingerprint in changed], console)
+    finally:
+        finish_resolution()
+
+    for (module, fingerprint), links in zip(changed, results):
+        if links is None:
+            statuses[module.name] = "failed"
+            continue
+        state[module.name] = {"url": links[0], "fingerprint": fingerprint, "sha256": checksums.get(links[0]),
+                              "checked": now}
+        if has_file(manifest, module, links[0]):
+            statuses[module.name] = "up to date"
+        else:
+            missing.append((module, links))
+
+    retired = set()
+    manifest = load_state("manifest.json")
+    for module, links in missing:
+        if module.name in manifest and exists(os.path.join(download_path, manifest[module.name]["path"])):
+            retire_download(module.name)
+            retired.add(module.name)
+        jobs.append(make_job(module, links))
+
+    save_state("sync_state.json", state)
+    if jobs:
+        download_jobs(jobs)
+
+    manifest = load_state("manifest.json")
+    catalog = get_catalog()
+    for job in jobs:
+        if has_file(manifest, catalog[job["module"]], job["url"]):
+            statuses[job["module"]] = "updated" if job["module"] in retired else "downloaded"
+        else:
+            statuses[job["module"]] = "failed"
+    if any(status == "updated" for status in statuses.values()):
+        cleanup_old_files(dry_run=not retention_auto)
+    return statuses
+
+
+def sync(names=None):
+    """Update the library without the menu, for cron jobs and timers.
+
+    Modules checked within sync_interval are skipped. The others are only
+    resolved again when the fingerprint of their upstream listing changed.
+    New versions are downloaded and the file they replace is retired to old/.
+    Everything human readable goes to stderr, stdout gets a JSON summary
+    that is also kept in .iso-manager/last_sync.json. Returns the exit code:
+    0 when every module is in place, 1 when some failed, 2 for unknown
+    module names and 130 when interrupted.
+    """
+    from rich.console import Console
+
+    console = Console(stderr=True)
+    catalog = get_catalog()
+    unknown = [name for name in names or [] if name not in catalog]
+    if unknown:
+        console.log(f"[bold red]Unknown module(s): {', '.join(unknown)}")
+        return 2
+
+    start_metrics()
+    started = time.time()
+    with redirect_stdout(sys.stderr):
+        statuses = run_sync([catalog[name] for name in names or catalog], console)
+    write_metrics()
+
+    counts = {}
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+    summary = {
+        "started": started,
+        "seconds": round(time.time() - started, 3),
+        "interrupted": done_event.is_set(),
+        "counts": counts,
+        "modules": statuses,
+    }
+    save_state("last_sync.json", summary)
+    print(json.dumps(summary))
+
+    if done_event.is_set():
+        return 130
+    return 1 if counts.get("failed") else 0
+
+
+# files a download is still writing or a link is being made through, never served
+HIDDEN_SUFFIXES = (PART_SUFFIX, f"{PART_SUFFIX}.json", ".link", ".tmp")
+
+
+def hidden(name):
+    """Tell whether a library entry stays private, like state, store, quarantine and unfinished files."""
+    return name.startswith(".") or name == "quarantine" or name.endswith(HIDDEN_SUFFIXES)
+
+
+def library_path(url_path):
+    """Map a request path onto the library, None for hidden entries."""
+    parts = [part for part in unquote(urlsplit(url_path).path).split("/") if part]
+    if any(hidden(part) for part in parts):
+        return None
+    return os.path.join(download_path, *parts)
+
+
+def library_index(url_path, local):
+    """Render a nginx style autoindex, the layout http_traverse parses on the real mirrors."""
+    title = html.escape(unquote(urlsplit(url_path).path))
+    rows = [f"<html><head><title>Index of {title}</title></head><body><h1>Index of {title}</h1><hr><pre>",
+            '<a href="../">../</a>']
+    for entry in sorted(os.scandir(local), key=lambda entry: entry.name):
+        if hidden(entry.name):
+            continue
+        name = f"{entry.name}/" if entry.is_dir() else entry.name
+        stat = entry.stat()
+        rows.append(f'<a href="{quote(name)}">{html.escape(name)}</a>{" " * max(1, 51 - len(name))}'
+                    f'{time.strftime("%d-%b-%Y %H:%M", time.gmtime(stat.st_mtime))} {"-" if entry.is_dir() else stat.st_size:>19}')
+    rows.append("</pre><hr></body></html>")
+    return "\n".join(rows).encode()
+
+
+def requested_range(header, size):
+    """Return the first and last byte of a single range Range header, None for the whole file.
+
+    Raises ValueError when the range lies outside the file.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        first, last = max(0, size - int(last)), size - 1
+    if first > last:
+        raise ValueError(header)
+    return first, last
+
+
+def library_handler():
+    """Return the request handler of serve_library, http.server is only loaded for --serve."""
+    from email.utils import formatdate
+    from http.server import BaseHTTPRequestHandler
+
+    class LibraryHandler(BaseHTTPRequestHandler):
+        """Serve the library read-only to other ISO-Manager instances."""
+        protocol_version = "HTTP/1.1"
+        server_version = "ISO-Manager"
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
 
-    for path in categories:
-        download_paths.append(f"{download_path}/{path}")
+        def do_HEAD(self):
+            self.do_GET()
 
-    if check_version:
-        return [file, download_paths, os_list]
-    else:
-        download(file, download_paths)
+        def do_GET(self):
+            local = library_path(self.path)
+            if local is None or not exists(local):
+                self.send_error(404)
+            elif os.path.isdir(local):
+                self.send_index(local)
+            else:
+                self.send_file(local)
+
+        def send_index(self, local):
+            path = urlsplit(self.path).path
+            if not path.endswith("/"):
+                # relative links of the index only work below the directory
+                self.send_response(301)
+                self.send_header("Location", f"{path}/")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
 
+            body = library_index(self.path, local)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def send_file(self, local):
+            with open(local, "rb") as file:
+                stat = os.fstat(file.fileno())
+                etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+                last_modified = formatdate(stat.st_mtime, usegmt=True)
+                try:
+                    byte_range = requested_range(self.headers.get("Range", ""), stat.st_size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if self.headers.get("If-Range") not in (None, etag, last_modified):
+                    byte_range = None
+
+                first, last = byte_range or (0, stat.st_size - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(last - first + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{stat.st_size}")
+                self.end_headers()
+                if self.command != "HEAD" and last >= first:
+                    self.wfile.flush()
+                    # the kernel copies from the page cache to the socket, the data never enters python
+                    self.connection.sendfile(file, first, last - first + 1)
+
+    return LibraryHandler
+
+
+def serve_library(port=None):
+    """Serve the library over HTTP until Ctrl+C.
+
+    Other instances set lan_cache to this server, they look up every file
+    under <category>/<filename> first and go upstream when it's missing.
+    """
+    from http.server import ThreadingHTTPServer
+
+    from rich.console import Console
 
-def cleanup_old_files():
-    total_size = 0
-    folder_size = []
-    folders = os.listdir(download_path)
-    for folder in folders:
-        if exists(f"{download_path}/{folder}/old"):
-            size = 0
-            for entry in os.listdir(f"{download_path}/{folder}/old"):
-                if os.path.isfile(f"{download_path}/{folder}/old/{entry}"):
-                    size += os.path.getsize(f"{download_path}/{folder}/old/{entry}")
-            total_size += size
-            folder_size.append([folder, size])
+    console = Console()
+    server = ThreadingHTTPServer((serve_address, port or serve_port), library_handler())
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    console.log(f"Serving {download_path} on port {server.server_port}, "
+                f"set lan_cache = http://<this host>:{server.server_port} on the other machines")
 
-    print(total_size)
-    print(folder_size)
+    while not done_event.wait(0.5):
+        pass
+    server.shutdown()
+    server.server_close()
 
 
 def main():
+    from simple_term_menu import TerminalMenu
+
     clear()
     read_settings(SETTINGS_FILE)
     setup()
@@ -340,6 +2514,7 @@ def main():
         "Check For Updates",
         "View Category",
         "Manage Elements",
+        "Verify Library",
         "Settings",
         "Test",
         "Exit"
@@ -354,122 +2529,36 @@ def main():
 
         match menu_entry_index:
             case 0:
-                modules = os.listdir(MODULE_PATH)
-                os_list = []
-                for module in modules:
-                    os_list.append(module.split('.')[0])
+                os_list = list(get_catalog())
                 update(os_list, TEST_FTP_CONNECTION)
                 run = False
             case 1:
-                modules = os.listdir(MODULE_PATH)
-                os_list = []
+                os_list = list(get_catalog())
                 systems_to_update = []
-                old_files = []
-                for module in modules:
-                    os_list.append(module.split('.')[0])
                 object = update(os_list, True)
-                existing_downloads = []
-                for folder in os.listdir(download_path):
-                    for file in os.listdir(f"{download_path}/{folder}"):
-                        existing_downloads.append(file)
-
-                # check if any given files already exist
-                for entry in object[0]:
-                    filename = entry[0].split('/')[-1]
-                    print(filename)
-                    file_download_path = str(object[1][object[0].index(entry)])
-                    if filename in existing_downloads:
-                        print(f"{object[2][object[0].index(entry)]} up to date")
+                manifest = load_state("manifest.json")
+
+                for links, file_download_path, name in zip(*object):
+                    filename = links[0].split('/')[-1]
+                    entry = manifest.get(name)
+                    if entry is None and exists(f"{file_download_path}/{filename}"):
+                        # downloaded before the manifest existed
+                        record_download(name, f"{file_download_path}/{filename}", links[0], None)
+                        print(f"{name} up to date")
+                        continue
+                    if entry is None and adopt_download(name, os.path.basename(file_download_path), filename):
+                        entry = load_state("manifest.json")[name]
+                    if entry is None or not exists(os.path.join(download_path, entry["path"])):
+                        print(f"{name} not downloaded")
+                    elif entry["file"] == filename:
+                        print(f"{name} up to date")
                     else:
-                        match file_download_path.split("/")[-1]:
-                            case "arch" :
-                                if exists(file_download_path):
-                                    for element in os.listdir(file_download_path):
-                                        if f"{filename.split('-')[0]}" in element:
-                                            print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                            if not object[2][object[0].index(entry)] in systems_to_update:
-                                                systems_to_update.append(object[2][object[0].index(entry)])
-                                            if not element in old_files:
-                                                old_files.append(element)
-                            case "ubuntu":
-                                match filename.split('-')[1]:
-                                    case "budgie" | "mate" | "unity":
-                                        if exists(file_download_path):
-                                            for element in os.listdir(file_download_path):
-                                                if f"{filename.split('-')[0]}-{filename.split('-')[1]}" in element:
-                                                    print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                                    if not object[2][object[0].index(entry)] in systems_to_update:
-                                                        systems_to_update.append(object[2][object[0].index(entry)])
-                                                    if not element in old_files:
-                                                        old_files.append(element)
-                                    case _:
-                                        if filename.split('-')[0] == "ubuntu":
-                                            if exists(file_download_path):
-                                                for element in os.listdir(file_download_path):
-                                                    if element.split('-')[0] == "ubuntu" and not (element.split('-')[1] in ['budgie', 'unity', 'mate']):
-                                                        if "beta" in filename:
-                                                            if f"{filename.split('-')[0]}" in element and f"{filename.split('-')[3]}" in element:
-                                                                print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                                                if not object[2][
-                                                                           object[0].index(entry)] in systems_to_update:
-                                                                    systems_to_update.append(
-                                                                        object[2][object[0].index(entry)])
-                                                                if not element in old_files:
-                                                                    old_files.append(element)
-                                                        else:
-                                                            if f"{filename.split('-')[0]}" in element and f"{filename.split('-')[2]}" in element:
-                                                                print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                                                if not object[2][
-                                                                           object[0].index(entry)] in systems_to_update:
-                                                                    systems_to_update.append(
-                                                                        object[2][object[0].index(entry)])
-                                                                if not element in old_files:
-                                                                    old_files.append(element)
-                                        else:
-                                            if exists(file_download_path):
-                                                for element in os.listdir(file_download_path):
-                                                    if f"{filename.split('-')[0]}" in element:
-                                                        print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                                        if not object[2][object[0].index(entry)] in systems_to_update:
-                                                            systems_to_update.append(object[2][object[0].index(entry)])
-                                                        if not element in old_files:
-                                                            old_files.append(element)
-                            case "garuda":
-                                if exists(file_download_path):
-                                    for element in os.listdir(file_download_path):
-                                        if f"{filename.split(filename.split('-')[-1])[0]}" in element:
-                                            print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                            if not object[2][object[0].index(entry)] in systems_to_update:
-                                                systems_to_update.append(object[2][object[0].index(entry)])
-                                            if not element in old_files:
-                                                old_files.append(element)
-                            case "kali":
-                                if exists(file_download_path):
-                                    for element in os.listdir(file_download_path):
-                                        if f"{filename.split('-')[0]}" in element and f"{filename.split('-')[3]}" in element and f"{filename.split('-')[4]}" in element:
-                                            print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                            if not object[2][object[0].index(entry)] in systems_to_update:
-                                                systems_to_update.append(object[2][object[0].index(entry)])
-                                            if not element in old_files:
-                                                old_files.append(element)
-                            case "mint":
-                                if exists(file_download_path):
-                                    for element in os.listdir(file_download_path):
-                                        if f"{filename.split('-')[0]}" in element and f"{filename.split('-')[2]}" in element:
-                                            print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                            if not object[2][object[0].index(entry)] in systems_to_update:
-                                                systems_to_update.append(object[2][object[0].index(entry)])
-                                            if not element in old_files:
-                                                old_files.append(element)
-                            case "manjaro":
-                                if exists(file_download_path):
-                                    for element in os.listdir(file_download_path):
-                                        if f"{filename.split('-')[0]}" in element and f"{filename.split('-')[1]}" in element:
-                                            print(f"an older file exists for {filename} -> {object[2][object[0].index(entry)]}")
-                                            if not object[2][object[0].index(entry)] in systems_to_update:
-                                                systems_to_update.append(object[2][object[0].index(entry)])
-                                            if not element in old_files:
-                                                old_files.append(element)
+                        print(f"an older file exists for {filename} -> {name}")
+                        systems_to_update.append(name)
+
+                if not systems_to_update:
+                    print("Everything up to date")
+                    continue
 
                 clear()
                 terminal_menu_update = TerminalMenu(systems_to_update, multi_select=True)
@@ -481,24 +2570,17 @@ def main():
 
                     if os_update_list:
                         for entry in os_update_list:
-                            if not exists(f"{object[1][object[2].index(entry)]}/old"):
-                                os.makedirs(f"{object[1][object[2].index(entry)]}/old")
-                            shutil.move(f"{object[1][object[2].index(entry)]}/{old_files[systems_to_update.index(entry)]}", f"{object[1][object[2].index(entry)]}/old/{old_files[systems_to_update.index(entry)]}")
+                            retire_download(entry)
 
                         update(os_update_list, TEST_FTP_CONNECTION)
-                        cleanup_old_files()
+                        cleanup_old_files(dry_run=not retention_auto)
                 else:
                     print("Nothing selected to update")
             case 2:
-                available = os.listdir(MODULE_PATH)
                 modules = []
 
-                for module in available:
-                    temp = read_conf(module.split('.')[0])
-                    category = temp[0].split('= ')[1].strip()
-                    system = module
-                    if category not in modules:
-                        modules.append([category, system])
+                for module in get_catalog().values():
+                    modules.append([module.category, f"{module.name}.conf"])
 
                 module_names = []
                 for object in modules:
@@ -543,13 +2625,43 @@ def main():
             case 3:
                 pass
             case 4:
-                pass
+                verify_library()
+                run = False
             case 5:
+                pass
+            case 6:
                 cleanup_old_files()
                 run = False
-            case 6:
+            case 7:
                 run = False
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Download and update Linux ISO images")
+    parser.add_argument("--refresh", action="store_true", help="ignore cached index pages and fetch them again")
+    parser.add_argument("--verify", action="store_true", help="verify the checksums of the whole library and exit")
+    parser.add_argument("--dedup", action="store_true", help="move the library into the content store and exit")
+    parser.add_argument("--cleanup", action="store_true", help="apply the retention policy to the old folders and exit")
+    parser.add_argument("--dry-run", action="store_true", help="with --cleanup, only report what would be deleted")
+    parser.add_argument("--serve", action="store_true", help="serve the library over HTTP as a LAN cache")
+    parser.add_argument("--port", type=int, help="with --serve, the port to listen on instead of serve_port")
+    parser.add_argument("--sync", nargs="*", metavar="MODULE",
+                        help="update all or the given modules without the menu and print a JSON summary")
+    args = parser.parse_args()
+
+    refresh_listings = args.refresh
+    if args.verify or args.dedup or args.cleanup or args.serve or args.sync is not None:
+        read_settings(SETTINGS_FILE)
+        setup()
+        if args.sync is not None:
+            sys.exit(sync(args.sync))
+        elif args.serve:
+            serve_library(args.port)
+        elif args.dedup:
+            dedup_library()
+        elif args.cleanup:
+            cleanup_old_files(dry_run=args.dry_run)
+        else:
+            verify_library()
+    else:
+        main()
@@ -0,0 +1,588 @@
+#! /bin/python
+
+"""Offline benchmarks for ISO-Manager.
+
+    python benchmark.py parser [--entries 20000] [--repeat 5]
+    python benchmark.py throughput [--size 512] [--repeat 3]
+    python benchmark.py mirrors [--size 4G] [--builds 30] [--downloads 2] [--engine both]
+                                [--latency 0] [--bandwidth 0]
+
+The mirrors benchmark serves synthetic trees shaped like the real Ubuntu,
+Arch, Garuda, Kali, Mint and Manjaro mirrors over local HTTP and FTP, with
+sparse images so multi-GB downloads cost no disk space on the server side.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import posixpath
+import re
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+
+def load_iso_manager():
+    """Import ISO-Manager.py, its file name isn't a valid module name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ISO-Manager.py")
+    spec = importlib.util.spec_from_file_location("iso_manager", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def autoindex_page(entries):
+    """Build a nginx style index page like the Garuda build directories."""
+    rows = ["<html><head><title>Index of /iso/garuda/</title></head><body><h1>Index of /iso/garuda/</h1><hr><pre>",
+            '<a href="../">../</a>']
+    for entry in range(entries):
+        name = f"{240000 + entry}/" if entry % 2 else f"garuda-edition-linux-zen-{240000 + entry}.iso"
+        rows.append(f'<a href="{name}">{name}</a>{" " * 30}18-Oct-2024 08:00    {entry * 1024}')
+    rows.append("</pre><hr></body></html>")
+    return "\n".join(rows).encode()
+
+
+def serve(body, content_type="text/html; charset=utf-8"):
+    """Serve body on a local port from a background thread, returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(function, repeat):
+    """Return the best wall time and the peak traced memory of function over repeat runs."""
+    best = float("inf")
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def bench_parser(entries, repeat):
+    """Compare the streaming LinkExtractor with a full BeautifulSoup parse of the same page."""
+    import requests
+
+    iso_manager = load_iso_manager()
+    body = autoindex_page(entries)
+    server = serve(body)
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    def streaming():
+        with requests.get(url, stream=True) as response:
+            return iso_manager.extract_links(response, iso_manager.is_build_dir)
+
+    candidates = {"LinkExtractor": streaming}
+    try:
+        from bs4 import BeautifulSoup
+
+        def beautifulsoup():
+            soup = BeautifulSoup(requests.get(url).content, 'html.parser')
+            return [link["href"] for link in soup.find_all("a", href=True) if iso_manager.is_build_dir(link["href"])]
+
+        candidates["BeautifulSoup"] = beautifulsoup
+    except ImportError:
+        print("beautifulsoup4 is not installed, only the streaming extractor is measured")
+
+    print(f"index page with {entries} entries, {len(body) / 1024:.0f} KiB, best of {repeat}")
+    results = {}
+    for name, function in candidates.items():
+        seconds, peak, links = measure(function, repeat)
+        results[name] = links
+        print(f"{name:>14}: {seconds * 1000:8.1f} ms  {peak / 1024:10.0f} KiB peak  {len(links)} links")
+
+    server.shutdown()
+    if len(set(map(tuple, results.values()))) > 1:
+        print("warning: the parsers found different links")
+
+
+def legacy_copy(iso_manager, task_id, url, path):
+    """The write path before preallocation and buffer reuse, a new bytes object per 32 KiB read."""
+    from functools import partial
+    from urllib.request import urlopen
+
+    digest = hashlib.sha256()
+    response = urlopen(url)
+    with open(path, "wb") as dest_file:
+        for data in iter(partial(response.read, 32768), b""):
+            dest_file.write(data)
+            digest.update(data)
+            iso_manager.progress.update(task_id, advance=len(data))
+    return digest.hexdigest()
+
+
+def bench_throughput(size, repeat):
+    """Compare the copy_url write path with the old 32 KiB read loop on a local transfer.
+
+    CPU time is counted for the downloading thread only, the server runs in
+    this process as well.
+    """
+    iso_manager = load_iso_manager()
+    body = os.urandom(size * 1024 * 1024)
+    expected = hashlib.sha256(body).hexdigest()
+    server = serve(body, "application/octet-stream")
+    url = f"http://127.0.0.1:{server.server_port}/bench.iso"
+    directory = tempfile.mkdtemp(prefix="iso-manager-bench-")
+    iso_manager.download_path = directory
+    iso_manager.content_store = 0
+    iso_manager.download_progress()
+    path = os.path.join(directory, "bench.iso")
+
+    def current():
+        task_id = iso_manager.progress.add_task("download", filename="bench.iso")
+        iso_manager.copy_url(task_id, url, path, 1, expected)
+        return iso_manager.load_state("checksums.json").get("bench.iso")
+
+    def legacy():
+        task_id = iso_manager.progress.add_task("download", filename="bench.iso")
+        return legacy_copy(iso_manager, task_id, url, path)
+
+    print(f"{size} MiB over loopback, chunk_size {iso_manager.chunk_size // 1024} KiB, best of {repeat}")
+    try:
+        for name, function in {"32 KiB reads": legacy, "copy_url": current}.items():
+            best = (float("inf"), 0)
+            for _ in range(repeat):
+                if os.path.exists(path):
+                    os.remove(path)
+                start, cpu = time.perf_counter(), time.thread_time()
+                digest = function()
+                best = min(best, (time.perf_counter() - start, time.thread_time() - cpu))
+                if digest != expected:
+                    print(f"warning: {name} wrote a different file")
+            seconds, cpu = best
+            print(f"{name:>14}: {size / seconds:8.1f} MiB/s  {cpu * 1000 / size:6.2f} ms CPU per MiB")
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+UBUNTU_VERSIONS = ["22.04", "24.04", "24.10"]
+# flavour directory under /cdimage and the images of one of its releases
+CDIMAGE_FLAVOURS = {
+    "edubuntu": ["edubuntu-{version}-desktop-amd64.iso"],
+    "kubuntu": ["kubuntu-{version}-desktop-amd64.iso"],
+    "lubuntu": ["lubuntu-{version}-desktop-amd64.iso"],
+    "ubuntucinnamon": ["ubuntucinnamon-{version}-desktop-amd64.iso"],
+    "ubuntustudio": ["ubuntustudio-{version}-dvd-amd64.iso"],
+    "xubuntu": ["xubuntu-{version}-desktop-amd64.iso", "xubuntu-{version}-minimal-amd64.iso"],
+    "ubuntu-budgie": ["ubuntu-budgie-{version}-desktop-amd64.iso"],
+    "ubuntu-mate": ["ubuntu-mate-{version}-desktop-amd64.iso"],
+    "ubuntu-unity": ["ubuntu-unity-{version}-desktop-amd64.iso"],
+}
+GARUDA_EDITIONS = ["garuda/cinnamon", "garuda/dr460nized", "garuda/dr460nized-gaming", "garuda/gnome", "garuda/hyprland",
+                   "garuda/i3", "garuda/kde-lite", "garuda/mokka", "garuda/sway", "garuda/xfce", "community/cosmic"]
+KALI_VERSION = "2024.3"
+MINT_VERSIONS = ["20.3", "21", "21.1", "21.2", "21.3", "22"]
+# in the order the manjaro modules pick them by their options value
+MANJARO_EDITIONS = ["kde", "xfce", "gnome", "cinnamon", "i3"]
+MANJARO_VERSION = "24.1.1"
+ARCH_RELEASE = "2024.10.01"
+
+
+def sparse_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.truncate(size)
+
+
+def text_file(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(text)
+
+
+def zero_sha256(size):
+    """Hash of size zero bytes, which is what every sparse image reads as."""
+    digest = hashlib.sha256()
+    block = bytes(1024 * 1024)
+    for _ in range(size // len(block)):
+        digest.update(block)
+    digest.update(bytes(size % len(block)))
+    return digest.hexdigest()
+
+
+def images(directory, names, size, digest, sums=None):
+    """Create sparse images with their usual side files, sums names a shared checksum list."""
+    for name in names:
+        sparse_file(os.path.join(directory, name), size)
+        text_file(os.path.join(directory, f"{name}.torrent"), "d8:announce0:e")
+        if sums is None:
+            text_file(os.path.join(directory, f"{name}.sha256"), f"{digest}  {name}\n")
+    if sums:
+        text_file(os.path.join(directory, sums), "".join(f"{digest} *{name}\n" for name in names))
+
+
+def build_mirror_tree(root, host, size, builds):
+    """Lay out the directories of the real mirrors under root, every image a sparse file of size bytes.
+
+    The paths follow the cwd of the shipped modules, so the modules resolve
+    against the tree once their server is replaced by host.
+    """
+    digest = zero_sha256(size)
+
+    for version in UBUNTU_VERSIONS:
+        images(f"{root}/releases/{version}", [f"ubuntu-{version}-desktop-amd64.iso",
+                                              f"ubuntu-{version}-live-server-amd64.iso"], size, digest, "SHA256SUMS")
+        for flavour, names in CDIMAGE_FLAVOURS.items():
+            directory = f"{root}/cdimage/{flavour}/releases/{version}/release"
+            names = [name.format(version=version) for name in names]
+            images(directory, names, size, digest, "SHA256SUMS")
+            for name in names:
+                text_file(os.path.join(directory, f"{name[:-len('.iso')]}.manifest"), "casper 1.0\n")
+
+    images(f"{root}/archlinux/iso/latest", [f"archlinux-{ARCH_RELEASE}-x86_64.iso", "archlinux-x86_64.iso"],
+           size, digest, "sha256sums.txt")
+    sparse_file(f"{root}/archlinux/iso/latest/archlinux-bootstrap-{ARCH_RELEASE}-x86_64.tar.zst", 1024 * 1024)
+
+    for edition in GARUDA_EDITIONS:
+        name = edition.split("/")[-1]
+        for build in range(241001, 241001 + builds):
+            images(f"{root}/iso/{edition}/{build}", [f"garuda-{name}-linux-zen-{build}.iso"], size, digest)
+
+    images(f"{root}/current", [f"kali-linux-{KALI_VERSION}-{kind}-{arch}.iso" for arch in ("amd64", "arm64")
+                               for kind in ("installer", "installer-netinst", "installer-purple", "live")],
+           size, digest, "SHA256SUMS")
+
+    for version in MINT_VERSIONS:
+        images(f"{root}/linuxmint-cd/stable/{version}",
+               [f"linuxmint-{version}-{edition}-64bit.iso" for edition in ("cinnamon", "mate", "xfce")],
+               size, digest, "sha256sum.txt")
+
+    links = []
+    for edition in MANJARO_EDITIONS:
+        name = f"manjaro-{edition}-{MANJARO_VERSION}-241001-linux610.iso"
+        images(f"{root}/download.manjaro.org/{edition}/{MANJARO_VERSION}", [name], size, digest)
+        links.append(f"http://{host}/download.manjaro.org/{edition}/{MANJARO_VERSION}/{name}")
+    links += [f"{link}.torrent" for link in links] + [f"{link}.sha256" for link in links]
+    text_file(f"{root}/products/download/x86/index.html",
+              "<html><body><nav><a href=\"/\">Home</a><a href=\"/news\">News</a></nav>"
+              + "".join(f'<div class="edition"><a href="{link}">{link.split("/")[-1]}</a></div>' for link in links)
+              + "</body></html>")
+
+
+def directory_page(path, local):
+    """Render a nginx style autoindex of a local directory."""
+    rows = [f"<html><head><title>Index of {path}</title></head><body><h1>Index of {path}</h1><hr><pre>",
+            '<a href="../">../</a>']
+    for entry in sorted(os.scandir(local), key=lambda entry: entry.name):
+        name = f"{entry.name}/" if entry.is_dir() else entry.name
+        stat = entry.stat()
+        rows.append(f'<a href="{name}">{name}</a>{" " * max(1, 50 - len(name))}'
+                    f'{time.strftime("%d-%b-%Y %H:%M", time.gmtime(stat.st_mtime))}    {stat.st_size}')
+    rows.append("</pre><hr></body></html>")
+    return "\n".join(rows).encode()
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """Serve the mirror tree with autoindex pages, Range requests and the injected latency and bandwidth."""
+    protocol_version = "HTTP/1.1"
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, head=False):
+        time.sleep(self.server.latency)
+        # the resolvers join paths with doubled slashes just like against the real mirrors
+        path = posixpath.normpath(unquote(urlsplit(self.path).path))
+        local = os.path.join(self.server.root, path.lstrip("/"))
+
+        if os.path.isdir(local):
+            index = os.path.join(local, "index.html")
+            if os.path.exists(index):
+                with open(index, "rb") as file:
+                    body = file.read()
+            else:
+                body = directory_page(path, local)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return
+
+        if not os.path.isfile(local):
+            self.send_error(404)
+            return
+
+        stat = os.stat(local)
+        start, end = 0, stat.st_size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{int(stat.st_mtime):x}-{stat.st_size:x}"')
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.end_headers()
+        if not head:
+            with open(local, "rb") as file:
+                self.send_body(file, start, end - start + 1)
+
+    def send_body(self, file, offset, count):
+        self.wfile.flush()
+        rate = self.server.bandwidth
+        if not rate:
+            self.connection.sendfile(file, offset, count)
+            return
+
+        step = max(1, rate // 20)
+        while count:
+            data = os.pread(file.fileno(), min(step, count), offset)
+            self.wfile.write(data)
+            offset += len(data)
+            count -= len(data)
+            time.sleep(len(data) / rate)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of an anonymous FTP server for login, cwd and nlst over passive mode."""
+
+    def setup(self):
+        super().setup()
+        # replies are single small writes, Nagle would hold them back for the delayed ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, line):
+        time.sleep(self.server.latency)
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        cwd = "/"
+        listener = None
+        self.reply("220 ISO-Manager stand-in mirror")
+        for line in self.rfile:
+            command, _, argument = line.decode(errors="replace").strip().partition(" ")
+            command = command.upper()
+            if command == "USER":
+                self.reply("331 Any password will do")
+            elif command == "PASS":
+                self.reply("230 Logged in")
+            elif command in ("TYPE", "MODE", "STRU", "NOOP"):
+                self.reply("200 OK")
+            elif command == "SYST":
+                self.reply("215 UNIX Type: L8")
+            elif command == "PWD":
+                self.reply(f'257 "{cwd}"')
+            elif command == "CWD":
+                target = posixpath.normpath(posixpath.join(cwd, argument))
+                if os.path.isdir(os.path.join(self.server.root, target.lstrip("/"))):
+                    cwd = target
+                    self.reply("250 Directory changed")
+                else:
+                    self.reply("550 No such directory")
+            elif command == "PASV":
+                listener = socket.create_server(("127.0.0.1", 0))
+                port = listener.getsockname()[1]
+                self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})")
+            elif command == "NLST":
+                if listener is None:
+                    self.reply("425 Use PASV first")
+                    continue
+                self.reply("150 Here comes the listing")
+                connection, _ = listener.accept()
+                names = sorted(os.listdir(os.path.join(self.server.root, cwd.lstrip("/"))))
+                connection.sendall("".join(f"{name}\r\n" for name in names).encode())
+                connection.close()
+                listener.close()
+                listener = None
+                self.reply("226 Listing sent")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class FTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_mirrors(http_server, ftp_server):
+    threading.Thread(target=ftp_server.serve_forever, daemon=True).start()
+    http_server.serve_forever()
+
+
+def start_mirrors(root, size, builds, latency, bandwidth):
+    """Build the mirror tree and serve it over HTTP and FTP from a child process.
+
+    The servers run in their own process so the CPU time measured in this one
+    is only what ISO-Manager spends. Returns the process, the host:port of the
+    HTTP server and the FTP port.
+    """
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+    http_server.daemon_threads = True
+    ftp_server = FTPServer(("127.0.0.1", 0), FTPHandler)
+    for server in (http_server, ftp_server):
+        server.root = root
+        server.latency = latency
+        server.bandwidth = bandwidth
+
+    host = f"127.0.0.1:{http_server.server_port}"
+    build_mirror_tree(root, host, size, builds)
+    process = multiprocessing.get_context("fork").Process(target=serve_mirrors, args=(http_server, ftp_server), daemon=True)
+    process.start()
+    http_server.server_close()
+    ftp_server.server_close()
+    return process, host, ftp_server.server_address[1]
+
+
+def resolve_all(iso_manager, modules, refresh):
+    """Resolve every module against the stand-ins, returns the links, wall and CPU seconds."""
+    from rich.console import Console
+
+    iso_manager.refresh_listings = refresh
+    iso_manager.start_metrics()
+    start, cpu = time.perf_counter(), time.process_time()
+    iso_manager.start_resolution()
+    try:
+        results = iso_manager.resolve_modules(modules, Console(quiet=True))
+    finally:
+        iso_manager.finish_resolution()
+    return results, time.perf_counter() - start, time.process_time() - cpu
+
+
+def download_all(iso_manager, resolved, engine, directory):
+    """Download the resolved modules on one engine, returns the MiB stored, wall and CPU seconds."""
+    from concurrent.futures import ThreadPoolExecutor
+    from queue import PriorityQueue
+
+    iso_manager.download_path = directory
+    iso_manager.download_engine = engine
+    jobs = PriorityQueue()
+    for index, (module, links) in enumerate(resolved):
+        jobs.put((0, index, iso_manager.make_job(module, links)))
+    for worker in range(iso_manager.max_simultaneous_downloads):
+        jobs.put((float("inf"), worker, None))
+
+    start, cpu = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(max_workers=iso_manager.max_simultaneous_downloads) as downloads:
+        iso_manager.start_download_workers(downloads, jobs)
+    seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+    stored = sum(entry["size"] for entry in iso_manager.load_state("manifest.json").values())
+    return stored / 1024 / 1024, seconds, cpu
+
+
+def bench_mirrors(size, builds, downloads, engines, latency, bandwidth):
+    """Resolve all modules and download a few of them from local stand-ins of the real mirrors."""
+    iso_manager = load_iso_manager()
+    size = iso_manager.parse_size(size)
+    bandwidth = iso_manager.parse_size(bandwidth)
+    workdir = tempfile.mkdtemp(prefix="iso-manager-mirrors-")
+    process, host, ftp_port = start_mirrors(os.path.join(workdir, "mirror"), size, builds, latency, bandwidth)
+    try:
+        iso_manager.HTTP_SCHEME = "http"
+        iso_manager.FTP_PORT = ftp_port
+        iso_manager.MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Modules/")
+        iso_manager.download_path = os.path.join(workdir, "resolve")
+        iso_manager.download_progress()
+        modules = [module._replace(server=host, mirrors=[]) for module in iso_manager.get_catalog().values()]
+
+        print(f"{len(modules)} modules against {host} (ftp port {ftp_port}), {size / 1024 ** 3:.1f} GiB images, "
+              f"{builds} garuda builds, latency {latency * 1000:.0f} ms, "
+              f"bandwidth {f'{bandwidth / 1024 ** 2:.1f} MiB/s' if bandwidth else 'unlimited'} per connection")
+        for label, refresh in (("cold", True), ("cached", False)):
+            results, seconds, cpu = resolve_all(iso_manager, modules, refresh)
+            failed = [module.name for module, links in zip(modules, results) if links is None]
+            print(f"resolve {label:>6}: {seconds:7.3f} s  {cpu:6.3f} s CPU  {len(modules) - len(failed)}/{len(modules)} resolved"
+                  + (f"  failed: {', '.join(failed)}" if failed else ""))
+
+            phases = {}
+            for event in iso_manager.metric_events:
+                total = phases.setdefault(event["phase"], [0, 0.0])
+                total[0] += 1
+                total[1] += event["seconds"]
+            print("    " + "  ".join(f"{phase} {count}x {seconds:.3f}s" for phase, (count, seconds) in sorted(phases.items())))
+
+        resolved = [(module, links) for module, links in zip(modules, results) if links][:downloads]
+        iso_manager.max_simultaneous_downloads = max(1, len(resolved))
+        for engine in engines:
+            directory = os.path.join(workdir, engine)
+            mib, seconds, cpu = download_all(iso_manager, resolved, engine, directory)
+            print(f"download {engine:>7}: {mib:8.0f} MiB  {seconds:7.2f} s  {mib / seconds:8.1f} MiB/s  "
+                  f"{cpu * 1000 / max(mib, 1):6.2f} ms CPU per MiB")
+            shutil.rmtree(directory)
+    finally:
+        process.terminate()
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for ISO-Manager")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parser_bench = commands.add_parser("parser", help="index page link extraction")
+    parser_bench.add_argument("--entries", type=int, default=20000)
+    parser_bench.add_argument("--repeat", type=int, default=5)
+    throughput_bench = commands.add_parser("throughput", help="download write path")
+    throughput_bench.add_argument("--size", type=int, default=512, help="MiB to transfer")
+    throughput_bench.add_argument("--repeat", type=int, default=3)
+    mirrors_bench = commands.add_parser("mirrors", help="resolve and download against local stand-in mirrors")
+    mirrors_bench.add_argument("--size", default="4G", help="size of every image, like 512M or 4G")
+    mirrors_bench.add_argument("--builds", type=int, default=30, help="build directories per garuda edition")
+    mirrors_bench.add_argument("--downloads", type=int, default=2, help="resolved modules to download")
+    mirrors_bench.add_argument("--engine", choices=["threads", "asyncio", "both"], default="both")
+    mirrors_bench.add_argument("--latency", type=float, default=0, help="milliseconds added to every reply")
+    mirrors_bench.add_argument("--bandwidth", default="0", help="limit per connection, like 20M")
+    args = parser.parse_args()
+
+    if args.command == "parser":
+        bench_parser(args.entries, args.repeat)
+    elif args.command == "throughput":
+        bench_throughput(args.size, args.repeat)
+    elif args.command == "mirrors":
+        engines = ["threads", "asyncio"] if args.engine == "both" else [args.engine]
+        bench_mirrors(args.size, args.builds, args.downloads, engines, args.latency / 1000, args.bandwidth)
+
+
+if __name__ == "__main__":
+    main()
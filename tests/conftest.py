@@ -0,0 +1,16 @@
+import importlib.util
+import os
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ISO-Manager.py")
+
+
+@pytest.fixture
+def iso_manager(tmp_path):
+    """A fresh copy of ISO-Manager.py with its library in a temporary folder."""
+    spec = importlib.util.spec_from_file_location("iso_manager", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.download_path = str(tmp_path)
+    return module
@@ -0,0 +1,126 @@
+import os
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("", None),
+    ("bytes=0-", (0, 99)),
+    ("bytes=10-19", (10, 19)),
+    ("bytes=90-500", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=99-99", (99, 99)),
+    # several ranges, other units and malformed headers get the whole file
+    ("bytes=0-1,5-6", None),
+    ("bytes=-", None),
+    ("items=0-1", None),
+    ("bytes=a-b", None),
+])
+def test_requested_range(iso_manager, header, expected):
+    assert iso_manager.requested_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=100-", 100),
+    ("bytes=150-200", 100),
+    ("bytes=20-10", 100),
+    ("bytes=-0", 100),
+    ("bytes=0-", 0),
+])
+def test_requested_range_outside_the_file(iso_manager, header, size):
+    with pytest.raises(ValueError):
+        iso_manager.requested_range(header, size)
+
+
+@pytest.mark.parametrize("url_path, parts", [
+    ("/", []),
+    ("/ubuntu/", ["ubuntu"]),
+    ("/ubuntu/ubuntu-24.04-desktop-amd64.iso", ["ubuntu", "ubuntu-24.04-desktop-amd64.iso"]),
+    ("/ubuntu/sp%20ace.iso?download=1", ["ubuntu", "sp ace.iso"]),
+    ("/ubuntu//old/", ["ubuntu", "old"]),
+    # %2f only splits after decoding, and the parts can't climb out of the library
+    ("/ubuntu%2fold%2fa.iso", ["ubuntu", "old", "a.iso"]),
+    ("/%252e%252e/etc", ["%2e%2e", "etc"]),
+])
+def test_library_path(iso_manager, url_path, parts):
+    assert iso_manager.library_path(url_path) == os.path.join(iso_manager.download_path, *parts)
+
+
+@pytest.mark.parametrize("url_path", [
+    "/../etc/passwd",
+    "/ubuntu/../../etc/passwd",
+    "/%2e%2e/etc/passwd",
+    "/%2E%2E/etc/passwd",
+    "/ubuntu/%2e%2e%2f%2e%2e%2fetc/passwd",
+    "/ubuntu/..%2f..%2fetc/passwd",
+    "/.iso-manager/manifest.json",
+    "/.store/ab/abcdef",
+    "/ubuntu/quarantine/bad.iso",
+    "/ubuntu/a.iso.part",
+    "/ubuntu/a.iso.part.json",
+    "/ubuntu/a.iso.link",
+    "/ubuntu/a.iso.tmp",
+])
+def test_library_path_refuses_traversal_and_hidden_entries(iso_manager, url_path):
+    assert iso_manager.library_path(url_path) is None
+
+
+def test_index_lists_no_hidden_entries(iso_manager, tmp_path):
+    category = tmp_path / "ubuntu"
+    (category / "old").mkdir(parents=True)
+    (category / "quarantine").mkdir()
+    for name in ("a.iso", "b.iso.part", "b.iso.part.json", ".hidden"):
+        (category / name).write_bytes(b"x")
+
+    page = iso_manager.library_index("/ubuntu/", str(category)).decode()
+    assert 'href="a.iso"' in page and 'href="old/"' in page
+    for name in ("b.iso.part", "quarantine", ".hidden"):
+        assert name not in page
+
+
+@pytest.fixture
+def library_server(iso_manager, tmp_path):
+    from http.server import ThreadingHTTPServer
+
+    (tmp_path / "ubuntu").mkdir()
+    (tmp_path / "ubuntu" / "a.iso").write_bytes(bytes(range(100)))
+    (tmp_path / "ubuntu" / "b.iso.part").write_bytes(b"x")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), iso_manager.library_handler())
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def get(url, **headers):
+    try:
+        with urlopen(Request(url, headers=headers), timeout=10) as response:
+            return response.status, response.headers, response.read()
+    except HTTPError as error:
+        return error.code, error.headers, b""
+
+
+def test_server_answers_ranges(library_server):
+    status, headers, body = get(f"{library_server}/ubuntu/a.iso", Range="bytes=-10")
+    assert (status, headers["Content-Range"], body) == (206, "bytes 90-99/100", bytes(range(90, 100)))
+
+    status, headers, body = get(f"{library_server}/ubuntu/a.iso", Range="bytes=0-1,5-6")
+    assert (status, len(body)) == (200, 100)
+
+    status, headers, body = get(f"{library_server}/ubuntu/a.iso", Range="bytes=100-")
+    assert (status, headers["Content-Range"]) == (416, "bytes */100")
+
+
+def test_server_ignores_a_range_of_a_changed_file(library_server):
+    status, headers, body = get(f"{library_server}/ubuntu/a.iso", Range="bytes=0-9", **{"If-Range": '"stale"'})
+    assert (status, len(body)) == (200, 100)
+
+
+@pytest.mark.parametrize("url_path", ["/%2e%2e/%2e%2e/etc/passwd", "/ubuntu/b.iso.part", "/.iso-manager/"])
+def test_server_hides_traversal_and_private_files(library_server, url_path):
+    assert get(f"{library_server}{url_path}")[0] == 404
@@ -0,0 +1,124 @@
+import os
+import time
+
+import pytest
+
+DAY = 86400
+
+
+@pytest.fixture
+def library(iso_manager, tmp_path):
+    """Helpers to put retired files into ubuntu/old and record them in the manifest."""
+    old_dir = tmp_path / "ubuntu" / "old"
+    old_dir.mkdir(parents=True)
+    manifest = {}
+
+    def retire(name, days_ago, size=1, module="ubuntu", recorded=True, accessed_days_ago=None):
+        path = old_dir / name
+        path.write_bytes(b"\0" * size)
+        retired = time.time() - days_ago * DAY
+        accessed = time.time() - (days_ago if accessed_days_ago is None else accessed_days_ago) * DAY
+        os.utime(path, (accessed, retired))
+        if recorded:
+            entry = manifest.setdefault(module, {"history": []})
+            entry["history"].append({"path": os.path.relpath(path, tmp_path), "file": name, "retired": retired})
+        return str(path)
+
+    def plan():
+        old_files = {path: stat for path, stat in iso_manager.scan_old("ubuntu")}
+        return iso_manager.retention_plan(old_files, manifest)
+
+    iso_manager.retention_keep = 0
+    iso_manager.retention_max_age_days = 0
+    iso_manager.retention_max_old_size = 0
+    retire.plan = plan
+    retire.manifest = manifest
+    return retire
+
+
+def test_nothing_is_deleted_without_a_policy(library):
+    library("a.iso", 400)
+    library("b.iso", 1, recorded=False)
+    assert library.plan() == {}
+
+
+def test_keep_counts_per_module(iso_manager, library):
+    iso_manager.retention_keep = 2
+    oldest = library("ubuntu-22.04.iso", 30)
+    library("ubuntu-22.10.iso", 20)
+    library("ubuntu-23.04.iso", 10)
+    library("mint-21.iso", 40, module="mint")
+
+    assert library.plan() == {oldest: "more than 2 old versions of ubuntu"}
+
+
+def test_keep_ignores_files_not_in_the_manifest(iso_manager, library):
+    iso_manager.retention_keep = 1
+    library("ubuntu-23.04.iso", 10)
+    library("foreign-1.iso", 50, recorded=False)
+    library("foreign-2.iso", 60, recorded=False)
+
+    assert library.plan() == {}
+
+
+def test_age_uses_the_mtime_of_files_not_in_the_manifest(iso_manager, library):
+    iso_manager.retention_max_age_days = 30
+    old = library("ubuntu-22.04.iso", 45)
+    library("ubuntu-23.04.iso", 5)
+    foreign = library("foreign.iso", 31, recorded=False)
+
+    assert library.plan() == {old: "older than 30 days", foreign: "older than 30 days"}
+
+
+def test_keep_takes_precedence_over_age(iso_manager, library):
+    iso_manager.retention_keep = 1
+    iso_manager.retention_max_age_days = 30
+    oldest = library("ubuntu-22.04.iso", 60)
+    old = library("ubuntu-22.10.iso", 40)
+
+    assert library.plan() == {oldest: "more than 1 old versions of ubuntu", old: "older than 30 days"}
+
+
+def test_budget_evicts_least_recently_used_first(iso_manager, library):
+    iso_manager.retention_max_old_size = 200
+    cold = library("a.iso", 1, size=100, accessed_days_ago=9)
+    library("b.iso", 2, size=100, accessed_days_ago=1)
+    warm = library("c.iso", 3, size=100, accessed_days_ago=5, recorded=False)
+    library("d.iso", 4, size=50, accessed_days_ago=0)
+
+    assert library.plan() == {cold: "over the old/ size budget", warm: "over the old/ size budget"}
+
+
+def test_budget_counts_only_files_that_are_kept(iso_manager, library):
+    iso_manager.retention_keep = 1
+    iso_manager.retention_max_old_size = 100
+    dropped = library("ubuntu-22.04.iso", 20, size=100, accessed_days_ago=0)
+    library("ubuntu-23.04.iso", 10, size=100, accessed_days_ago=9)
+
+    assert library.plan() == {dropped: "more than 1 old versions of ubuntu"}
+
+
+def test_cleanup_dry_run_keeps_everything(iso_manager, library):
+    iso_manager.retention_keep = 1
+    oldest = library("ubuntu-22.04.iso", 20)
+    library("ubuntu-23.04.iso", 10)
+    iso_manager.save_state("manifest.json", library.manifest)
+
+    assert list(iso_manager.cleanup_old_files(dry_run=True)) == [oldest]
+    assert os.path.exists(oldest)
+    assert len(iso_manager.load_state("manifest.json")["ubuntu"]["history"]) == 2
+
+
+def test_cleanup_deletes_and_forgets_the_planned_files(iso_manager, library):
+    iso_manager.retention_keep = 1
+    iso_manager.content_store = 0
+    oldest = library("ubuntu-22.04.iso", 20)
+    kept = library("ubuntu-23.04.iso", 10)
+    foreign = library("foreign.iso", 400, recorded=False)
+    iso_manager.save_state("manifest.json", library.manifest)
+
+    assert list(iso_manager.cleanup_old_files(dry_run=False)) == [oldest]
+    assert not os.path.exists(oldest)
+    assert os.path.exists(kept) and os.path.exists(foreign)
+    assert [version["file"] for version in iso_manager.load_state("manifest.json")["ubuntu"]["history"]] == \
+        ["ubuntu-23.04.iso"]